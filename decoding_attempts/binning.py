@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binning of trials into ERP-bins for decoding.
+
+Trials are selected per class and iteration by an index array of shape
+(n_iterations, 2, n_per_class), i.e. a balanced random order of the trials of
+class 0 and class 1. The selected rows form contiguous class blocks, which are
+averaged in consecutive bins with one reshape and mean (or one np.add.reduceat
+for bins of different sizes). Trials left over after the last full bin are not
+used. The bins of all iterations are returned in one array of shape
+(n_iterations, 2, n_bins, n_features), as expected by decoding_engine.
+"""
+
+# Imports
+import numpy as np
+
+
+def balanced_permutations(y, n_iterations, random_state=None, classes=(0, 1)):
+    """Random trial orders of both classes, undersampled to the minority class.
+
+    Equivalent to random undersampling followed by shuffling, for all iterations
+    at once. Returns indices into y as (n_iterations, 2, n_per_class).
+    """
+
+    # Random number generator
+    rng = np.random.default_rng(random_state)
+
+    # Trial indices of classes
+    class_idx = [np.flatnonzero(y == c) for c in classes]
+    n_per_class = min(idx.size for idx in class_idx)
+
+    # Permute per iteration and keep the first n_per_class trials of each class
+    return np.stack(
+        [
+            rng.permuted(np.tile(idx, (n_iterations, 1)), axis=1)[:, :n_per_class]
+            for idx in class_idx
+        ],
+        axis=1,
+    )
+
+
+def bin_sizes(n_per_class, binsize):
+    """Sizes of consecutive bins of n_per_class trials.
+
+    binsize is either an int, giving n_per_class // binsize bins of that size,
+    or a sequence of bin sizes.
+    """
+
+    # Bins of equal size
+    if np.ndim(binsize) == 0:
+        return np.full((n_per_class // int(binsize),), int(binsize))
+
+    # Bins of given sizes
+    sizes = np.asarray(binsize, dtype=int)
+    if sizes.sum() > n_per_class or (sizes < 1).any():
+        raise ValueError(f"bin sizes {sizes.tolist()} do not fit {n_per_class} trials")
+
+    return sizes
+
+
+def bin_trials(X, idx, binsize=15):
+    """Average trials of both classes in bins, for all iterations at once.
+
+    X is (n_trials, n_features) and idx holds the trial order of the classes as
+    (n_iterations, 2, n_per_class), e.g. from balanced_permutations, or as
+    (2, n_per_class) for a single iteration. binsize is an int or a sequence of
+    bin sizes. Returns bins as (n_iterations, 2, n_bins, n_features), or as
+    (2, n_bins, n_features) for a single iteration.
+    """
+
+    # Get bin sizes
+    idx = np.asarray(idx)
+    sizes = bin_sizes(idx.shape[-1], binsize)
+    n_used = sizes.sum()
+
+    # Gather contiguous class blocks as (..., 2, n_used, n_features)
+    X_blocks = X[idx[..., :n_used], :]
+
+    # Bins of equal size: reshape to (..., 2, n_bins, binsize, n_features) and average
+    if np.ndim(binsize) == 0:
+        return X_blocks.reshape(
+            idx.shape[:-1] + (sizes.size, int(binsize), X.shape[-1])
+        ).mean(axis=-2)
+
+    # Bins of different sizes: sum segments, then divide by sizes
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    return np.add.reduceat(X_blocks, offsets, axis=-2) / sizes[:, None].astype(
+        X_blocks.dtype
+    )
@@ -4,6 +4,7 @@
 # Imports
 import glob
 import os
+import sys
 import joblib
 import numpy as np
 import sklearn.preprocessing
@@ -12,49 +13,67 @@ import sklearn.metrics
 import sklearn.decomposition
 import sklearn.linear_model
 import sklearn.svm
-import mne
-import imblearn
-import scipy.io
-
-# Set environment variable so solve issue with parallel crash
-# https://stackoverflow.com/questions/40115043/no-space-left-on-device-error-while-fitting-sklearn-model/49154587#49154587
-os.environ["JOBLIB_TEMP_FOLDER"] = "/tmp"
+import binning
+import resampling
+import rng_streams
+import task_specs
+import trial_filter
+import result_store
+import eeglab_io
+import decoding_dispatch
+import feature_provider
+
+# Append repository root to sys path for the shared trialinfo schema
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import trialinfo_schema
 
 # Define paths
 path_in = "/mnt/data_dump/bocotilt/2_autocleaned/"
 path_out = "/mnt/data_dump/bocotilt/3_decoding_data/erp/"
+path_shared = "/mnt/data_dump/bocotilt/3_decoding_data/erp/shared/"
 
-# Function that calls the classifications
-def decode_timeslice(X_all, trialinfo, decoding_task):
+# Base seed of all random draws. Streams are derived per subject, task, time slice and iteration
+random_seed = 42
 
-    # Select X and y data
-    X = X_all[decoding_task["trial_idx"], :]
-    y = trialinfo[decoding_task["trial_idx"], decoding_task["y_col"]]
+# Decoding tasks as decoding target x factors of trial selection, see task_specs
+tasks = (
+    task_specs.declare("bonus_vs_standard", ["sequence"])
+    + task_specs.declare("task", ["sequence", "reward"])
+    + task_specs.declare("cue", ["reward", "task"])
+    + task_specs.declare("response", ["reward", "task"])
+    + task_specs.declare("target", ["reward", "task"])
+    + task_specs.declare("distractor", ["reward", "task"])
+)
 
-    # Init undersampler
-    undersampler = imblearn.under_sampling.RandomUnderSampler(
-        sampling_strategy="not minority"
-    )
+
+# Function that calls the classifications
+def decode_timeslice(features_file, time_idx, decoding_task, plan, seed):
+
+    # Select X data from the shared features. Labels are implied by the class blocks of
+    # the resampling plan
+    X = decoding_dispatch.open_shared(*features_file)[time_idx][
+        decoding_task["trial_idx"], :
+    ]
 
     # Init classifier
     clf = sklearn.svm.SVC(kernel="linear")
 
-    # Set number of iterations
-    n_iterations = 10
-
     # List for classifier performance and feature importances
     acc = []
 
-    # Loop iterations
-    for _ in range(n_iterations):
+    # Set binsize
+    binsize = 10
 
-        # Undersample data
-        X_undersampled, y_undersampled = undersampler.fit_resample(X, y)
+    # Loop iterations of the resampling plan, each with its own random stream
+    for idx_undersampled, iteration_seed in zip(
+        plan.idx, rng_streams.children(seed, plan.n_iterations)
+    ):
 
-        # Shuffle data after undersampling
-        X_undersampled, y_undersampled = sklearn.utils.shuffle(
-            X_undersampled, y_undersampled
-        )
+        # Random state of shuffling in this iteration
+        random_state = np.random.RandomState(rng_streams.random_state(iteration_seed))
+
+        # Undersampled data as class blocks
+        X_undersampled = X[idx_undersampled.ravel(), :]
 
         # Scale data
         scaler = sklearn.preprocessing.StandardScaler()
@@ -64,27 +83,13 @@ def decode_timeslice(X_all, trialinfo, decoding_task):
         pca = sklearn.decomposition.PCA(n_components=0.9, svd_solver="full")
         X_undersampled = pca.fit_transform(X_undersampled)
 
-        # Get data for both classes
-        X0 = X_undersampled[y_undersampled == 0, :]
-        X1 = X_undersampled[y_undersampled == 1, :]
-
-        # Set binsize
-        binsize = 10
-
-        # Determine number of bins
-        n_bins_per_class = int(np.floor(X0.shape[0] / binsize))
-
-        # Get number of features
-        _, n_features = X0.shape
-
-        # Arrays for bins
-        X_binned_0 = np.zeros((n_bins_per_class, n_features))
-        X_binned_1 = np.zeros((n_bins_per_class, n_features))
-
-        # Binning. Create ERPs
-        for row_idx, X_idx in enumerate(np.arange(0, X0.shape[0], binsize)[:-1]):
-            X_binned_0[row_idx, :] = X0[X_idx : X_idx + binsize, :].mean(axis=0)
-            X_binned_1[row_idx, :] = X1[X_idx : X_idx + binsize, :].mean(axis=0)
+        # Binning. Create ERPs from the contiguous class blocks
+        X_binned_0, X_binned_1 = binning.bin_trials(
+            X_undersampled,
+            np.arange(idx_undersampled.size).reshape(idx_undersampled.shape),
+            binsize,
+        )
+        n_bins_per_class = X_binned_0.shape[0]
 
         # Iterate bins
         for bin_idx in range(n_bins_per_class):
@@ -96,7 +101,9 @@ def decode_timeslice(X_all, trialinfo, decoding_task):
             y_test = np.array((0, 1))
 
             # Shuffle test data
-            X_test, y_test = sklearn.utils.shuffle(X_test, y_test)
+            X_test, y_test = sklearn.utils.shuffle(
+                X_test, y_test, random_state=random_state
+            )
 
             # Exclude test bins from binned data
             X_train_0 = np.delete(X_binned_0, bin_idx, 0)
@@ -112,7 +119,9 @@ def decode_timeslice(X_all, trialinfo, decoding_task):
             )
 
             # Shuffle training data after bin creation
-            X_train, y_train = sklearn.utils.shuffle(X_train, y_train)
+            X_train, y_train = sklearn.utils.shuffle(
+                X_train, y_train, random_state=random_state
+            )
 
             # Fit model
             clf.fit(X_train, y_train)
@@ -139,44 +148,8 @@ for dataset_idx, dataset in enumerate(datasets):
     # Talk
     print(f"Decoding dataset {dataset_idx + 1} / {len(datasets)}.")
 
-    # Set sampling rate
-    srate = 200
-
-    # Read channel labels as list
-    channel_label_list = scipy.io.loadmat(os.path.join(path_in, "channel_labels.mat"))[
-        "channel_labels"
-    ][0].split(" ")[1:]
-
-    # Rename channels to match standard montage info of MNE
-    for x in range(len(channel_label_list)):
-        if channel_label_list[x] == "O9":
-            channel_label_list[x] = "OI1"
-        if channel_label_list[x] == "O10":
-            channel_label_list[x] = "OI2"
-
     # Load epoch data
-    eeg_data = scipy.io.loadmat(dataset)["data"].transpose((2, 0, 1))
-
-    # Create info struct
-    eeg_info = mne.create_info(channel_label_list, srate)
-
-    # Create epoch struct
-    eeg_epochs = mne.EpochsArray(eeg_data, eeg_info, tmin=-1).decimate(2)
-
-    # Create channel type mapping
-    mapping = {}
-    for x in channel_label_list:
-        mapping[x] = "eeg"
-
-    # Apply mapping
-    eeg_epochs.set_channel_types(mapping)
-
-    # Set montage
-    montage = mne.channels.make_standard_montage("standard_1005")
-    eeg_epochs.set_montage(montage)
-
-    # Load trialinfo
-    trialinfo = scipy.io.loadmat(dataset)["trialinfo"]
+    eeg_epochs = eeglab_io.load_epochs(dataset).decimate(2)
 
     # # Get indices of channels to pick
     # to_pick_labels = [
@@ -212,277 +185,90 @@ for dataset_idx, dataset in enumerate(datasets):
     tf_data = eeg_epochs.get_data()[:, :, to_keep_idx]  # Data is trial x channel x time
 
     # Clean up
-    del eeg_epochs, eeg_data
-
-    # Positions of target and distractor are coded  1-8, starting at the top-right position, then counting counter-clockwise
-
-    # Recode distractor and target positions in 4 bins 0-3 (c.f. https://www.nature.com/articles/s41598-019-45333-6)
-    # trialinfo[:, 19] = np.floor((trialinfo[:, 19] - 1) / 2)
-    # trialinfo[:, 20] = np.floor((trialinfo[:, 20] - 1) / 2)
-
-    # Recode distractor and target positions in 2 bins 0-1 (roughly left vs right...)
-    trialinfo[:, 20] = np.floor((trialinfo[:, 20] - 1) / 4)
-    trialinfo[:, 21] = np.floor((trialinfo[:, 21] - 1) / 4)
-
-    # Exclude trials: Practice-block trials and first-of-sequence trials and no-response trials
-    idx_to_keep = (
-        (trialinfo[:, 1] >= 5)
-        & (trialinfo[:, 22] > 1)
-        & ((trialinfo[:, 13] > -1) & (trialinfo[:, 13] < 2))
-    )
-    trialinfo = trialinfo[idx_to_keep, :]
-    tf_data = tf_data[idx_to_keep, :, :]
-
-    # get dims
-    n_trials, n_channels, _ = tf_data.shape
-
-    # Trialinfo cols:
-    # 00: id
-    # 01: block_nr
-    # 02: trial_nr
-    # 03: bonustrial
-    # 04: tilt_task
-    # 05: cue_ax
-    # 06: target_red_left
-    # 07: distractor_red_left
-    # 08: response_interference
-    # 09: task_switch
-    # 10: prev_switch
-    # 11: prev_accuracy
-    # 12: correct_response
-    # 13: response_side
-    # 14: rt
-    # 15: rt_thresh_color
-    # 16: rt_thresh_tilt
-    # 17: accuracy
-    # 18: position_color
-    # 19: position_tilt
-    # 20: position_target
-    # 21: position_distractor
-    # 22: sequence_position
-
-    # A list for stuff to classify
-    decoding_tasks = []
-
-    # Bonus decoding
-    decoding_tasks.append(
-        {
-            "label": "bonus_vs_standard_in_repeat",
-            "trial_idx": trialinfo[:, 9] == 0,
-            "y_col": 3,
-        }
-    )
-    
-    decoding_tasks.append(
-        {
-            "label": "bonus_vs_standard_in_switch",
-            "trial_idx": trialinfo[:, 9] == 1,
-            "y_col": 3,
-        }
+    del eeg_epochs
+
+    # Trialinfo of kept trials (recoded) and their trial numbers, see trial_filter.
+    # Trials are selected where data is read
+    trialinfo, trial_idx = trial_filter.load_or_compute(
+        None,
+        dataset,
+        lambda dataset: trialinfo_schema.from_matrix(
+            eeglab_io.open_dataset(dataset).trialinfo
+        ),
     )
 
-    # Task decoding
-    decoding_tasks.append(
-        {
-            "label": "task_in_repeat_in_standard",
-            "trial_idx": (trialinfo[:, 9] == 0) & (trialinfo[:, 3] == 0),
-            "y_col": 4,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "task_in_repeat_in_bonus",
-            "trial_idx": (trialinfo[:, 9] == 0) & (trialinfo[:, 3] == 1),
-            "y_col": 4,
-        }
-    )
-    
-    decoding_tasks.append(
-        {
-            "label": "task_in_repeat_in_standard",
-            "trial_idx": (trialinfo[:, 9] == 0) & (trialinfo[:, 3] == 0),
-            "y_col": 4,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "task_in_repeat_in_bonus",
-            "trial_idx": (trialinfo[:, 9] == 0) & (trialinfo[:, 3] == 1),
-            "y_col": 4,
-        }
-    )
-    
-    
-
-    # Cue decoding
-    decoding_tasks.append(
-        {
-            "label": "cue_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 3] == 0) & (trialinfo[:, 4] == 0),
-            "y_col": 5,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "cue_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 3] == 0) & (trialinfo[:, 4] == 1),
-            "y_col": 5,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "cue_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 3] == 1) & (trialinfo[:, 4] == 0),
-            "y_col": 5,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "cue_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 3] == 1) & (trialinfo[:, 4] == 1),
-            "y_col": 5,
-        }
+    # Trial masks of the decoding tasks, each distinct mask is computed once
+    compiled_tasks = task_specs.compile_tasks(trialinfo, tasks)
+    decoding_tasks = compiled_tasks.decoding_tasks()
+
+    # Re-arrange data. Time slices are read-only views of the temporally smoothed channel
+    # data of kept trials, with channels as a single band, memory-mapped from disk so that
+    # workers can share them
+    X_list = feature_provider.FeatureProvider(
+        tf_data[:, :, None, :],
+        tf_times,
+        temporal_smoothing=3,
+        memmap_file=os.path.join(path_shared, f"features_{id_string}.npy"),
+        trial_idx=trial_idx,
     )
+    tf_times = X_list.times
 
-    # Response decoding
-    decoding_tasks.append(
-        {
-            "label": "response_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 3] == 0) & (trialinfo[:, 4] == 0),
-            "y_col": 13,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "response_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 3] == 0) & (trialinfo[:, 4] == 1),
-            "y_col": 13,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "response_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 3] == 1) & (trialinfo[:, 4] == 0),
-            "y_col": 13,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "response_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 3] == 1) & (trialinfo[:, 4] == 1),
-            "y_col": 13,
-        }
-    )
+    # Clean up
+    del tf_data
 
-    # Target decoding
-    decoding_tasks.append(
-        {
-            "label": "target_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 3] == 0) & (trialinfo[:, 4] == 0),
-            "y_col": 20,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "target_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 3] == 0) & (trialinfo[:, 4] == 1),
-            "y_col": 20,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "target_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 3] == 1) & (trialinfo[:, 4] == 0),
-            "y_col": 20,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "target_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 3] == 1) & (trialinfo[:, 4] == 1),
-            "y_col": 20,
-        }
+    # Open result store of the analysis. Metadata is stored once, at the first dataset
+    store = result_store.create(
+        os.path.join(path_out, "results"),
+        [decoding_task["label"] for decoding_task in decoding_tasks],
+        [x.split("VP")[1][0:2] for x in datasets],
+        tf_times,
+        info_object=info_object,
+        tasks=tasks,
     )
 
-    # Distractor decoding
-    decoding_tasks.append(
-        {
-            "label": "distractor_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 3] == 0) & (trialinfo[:, 4] == 0),
-            "y_col": 21,
-        }
+    # Workers read the time slices from the shared features file and only receive its name.
+    # Labels are implied by the resampling plans
+    features_file, _ = decoding_dispatch.share_inputs(
+        X_list, trialinfo, path_shared, id_string
     )
-    decoding_tasks.append(
-        {
-            "label": "distractor_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 3] == 0) & (trialinfo[:, 4] == 1),
-            "y_col": 21,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "distractor_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 3] == 1) & (trialinfo[:, 4] == 0),
-            "y_col": 21,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "distractor_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 3] == 1) & (trialinfo[:, 4] == 1),
-            "y_col": 21,
-        }
-    )
-
-    # Re-arrange data
-    X_list = []
-    temporal_smoothing = 3
-    tf_times = tf_times[: -(temporal_smoothing - 1)]
-    for time_idx, timeval in enumerate(tf_times):
-
-        # Data as trials x channels x frequencies. Apply a temporal smoothing
-        timepoint_data = tf_data[:, :, time_idx : time_idx + temporal_smoothing].mean(
-            axis=2
-        )
-
-        # Trials in rows
-        timepoint_data_2d = timepoint_data.reshape((n_trials, n_channels))
-
-        # Stack data
-        X_list.append(timepoint_data_2d)
 
-    # Clean up
-    del tf_data
+    # Draw undersampling plans once per task, shared by all time slices
+    plans = resampling.make_plans(
+        trialinfo,
+        decoding_tasks,
+        n_iterations=10,
+        seed=rng_streams.stream(random_seed, int(id_string)),
+    )
 
     # Iterate classification-tasks
     for decoding_task in decoding_tasks:
 
-        # Specify out file name for decoding task
-        out_file = os.path.join(
-            path_out, f"{decoding_task['label']}_{id_string}.joblib"
-        )
-
         # Check if done already. If so -> skip
-        if os.path.isfile(out_file):
+        if store.is_done(decoding_task["label"], id_string):
             continue
 
         # Fit random forest
         out = joblib.Parallel(n_jobs=-2)(
-            joblib.delayed(decode_timeslice)(X, trialinfo, decoding_task)
-            for X in X_list
+            joblib.delayed(decode_timeslice)(
+                features_file,
+                time_idx,
+                decoding_task,
+                plans[decoding_task["label"]],
+                rng_streams.stream(
+                    random_seed, int(id_string), decoding_task["label"], time_idx
+                ),
+            )
+            for time_idx in range(len(X_list))
         )
 
         # Stack accuracies
         acc = np.stack([x for x in out])
 
-        # Compile output
-        output = {
-            "id": id_string,
-            "decode_label": decoding_task["label"],
-            "times": tf_times,
-            "acc": acc,
-            "info_object": info_object,
-        }
-
         # Save
-        joblib.dump(output, out_file)
+        store.write(decoding_task["label"], id_string, acc)
+
+    # Clean up shared features and trialinfo
+    del X_list
+    for file_name in (f"features_{id_string}.npy", f"trialinfo_{id_string}.npy"):
+        if os.path.isfile(os.path.join(path_shared, file_name)):
+            os.remove(os.path.join(path_shared, file_name))
@@ -2,85 +2,106 @@
 # -*- coding: utf-8 -*-
 
 # Imports
+import functools
 import glob
 import os
+import sys
 import joblib
 import numpy as np
 import sklearn.model_selection
 import sklearn.metrics
 import sklearn.ensemble
-import mne
-import imblearn
-import scipy.io
-
-# Set environment variable so solve issue with parallel crash
-# https://stackoverflow.com/questions/40115043/no-space-left-on-device-error-while-fitting-sklearn-model/49154587#49154587
-os.environ["JOBLIB_TEMP_FOLDER"] = "/tmp"
+import importance
+import resampling
+import rng_streams
+import task_specs
+import trial_filter
+import result_store
+import eeglab_io
+import decoding_dispatch
+import feature_provider
+import tf_cache
+import tf_features
+
+# Append repository root to sys path for the shared trialinfo schema
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import trialinfo_schema
 
 # Define paths
 path_in = "/mnt/data_dump/bocotilt/2_autocleaned/"
 path_out = "/mnt/data_dump/bocotilt/3_decoding_data/features_reduced_smoother/"
+path_cache = "/mnt/data_dump/bocotilt/3_decoding_data/tf_cache/"
+path_shared = (
+    "/mnt/data_dump/bocotilt/3_decoding_data/features_reduced_smoother/shared/"
+)
 
-# Function that calls the classifications
-def decode_timeslice(X_all, trialinfo, decoding_task):
+# Set numeric precision of features (random forests work in float32 internally)
+feature_dtype = "float32"
+
+# Number of trials read and transformed at once. Bounds memory of the time-frequency analysis
+tf_chunk_size = 32
+
+# Set feature importances: "impurity" (feature_importances_ of the forest) or "permutation"
+# (drop in accuracy on the held-out bins when permuting a feature, permutation_repeats times)
+importance_method = "impurity"
+permutation_repeats = 5
 
-    # Select X and y data
-    X = X_all[decoding_task["trial_idx"], :]
-    y = trialinfo[decoding_task["trial_idx"], decoding_task["y_col"]]
+# Base seed of all random draws. Streams are derived per subject, task, time slice and iteration
+random_seed = 42
+
+# Decoding tasks as decoding target x factors of trial selection, see task_specs
+tasks = task_specs.declare("bonus_vs_standard", ["sequence"]) + task_specs.declare(
+    "task", ["sequence", "reward"]
+)
+
+
+# Function that calls the classifications
+def decode_timeslice(
+    features_file, time_idx, decoding_task, plan, seed, n_channels, n_bands
+):
+
+    # Select X data from the shared features. Labels are implied by the class blocks of
+    # the resampling plan
+    X = decoding_dispatch.open_shared(*features_file)[time_idx][
+        decoding_task["trial_idx"], :
+    ]
 
     # Get dims
     n_trials, n_features = X.shape
 
-    # Init undersampler
-    undersampler = imblearn.under_sampling.RandomUnderSampler(
-        sampling_strategy="not minority"
-    )
-
     # Init classifier
     clf = sklearn.ensemble.RandomForestClassifier(
         n_estimators=100,
         max_depth=None,
         min_samples_split=2,
         min_samples_leaf=1,
-        random_state=42,
     )
 
-    # Set number of iterations
-    n_iterations = 10
-
-    # List for classifier performance and feature importances
+    # List for classifier performance, running mean and variance of feature importances
     acc = []
-    fmp = []
-
-    # Loop iterations
-    for _ in range(n_iterations):
-
-        # Undersample data
-        X_undersampled, y_undersampled = undersampler.fit_resample(X, y)
-
-        # Shuffle data after undersampling
-        X_undersampled, y_undersampled = sklearn.utils.shuffle(
-            X_undersampled, y_undersampled
-        )
+    fmp = importance.ImportanceAccumulator(n_channels, n_bands)
 
-        # Get data for both classes
-        X0 = X_undersampled[y_undersampled == 0, :]
-        X1 = X_undersampled[y_undersampled == 1, :]
+    # Set binsize
+    binsize = 10
 
-        # Set binsize
-        binsize = 10
+    # Bin the undersampled and shuffled trials of the plan, for all iterations at once.
+    # Bins are iterations x classes x bins x features
+    X_binned = plan.bin(X, binsize)
+    n_bins_per_class = X_binned.shape[2]
 
-        # Determine number of bins
-        n_bins_per_class = int(np.floor(X0.shape[0] / binsize))
+    # Loop iterations, each with its own random stream
+    for (X_binned_0, X_binned_1), iteration_seed in zip(
+        X_binned, rng_streams.children(seed, len(X_binned))
+    ):
 
-        # Arrays for bins
-        X_binned_0 = np.zeros((n_bins_per_class, n_features))
-        X_binned_1 = np.zeros((n_bins_per_class, n_features))
+        # Random state of shuffling and forest of this iteration
+        random_state = np.random.RandomState(rng_streams.random_state(iteration_seed))
+        clf.set_params(random_state=random_state)
 
-        # Binning. Create ERPs
-        for row_idx, X_idx in enumerate(np.arange(0, X0.shape[0], binsize)[:-1]):
-            X_binned_0[row_idx, :] = X0[X_idx : X_idx + binsize, :].mean(axis=0)
-            X_binned_1[row_idx, :] = X1[X_idx : X_idx + binsize, :].mean(axis=0)
+        # Separate stream for permutation importances, so decoding draws do not depend on them
+        permutation_state = np.random.RandomState(
+            rng_streams.random_state(iteration_seed, "permutation")
+        )
 
         # Iterate bins
         for bin_idx in range(n_bins_per_class):
@@ -92,7 +113,9 @@ def decode_timeslice(X_all, trialinfo, decoding_task):
             y_test = np.array((0, 1))
 
             # Shuffle test data
-            X_test, y_test = sklearn.utils.shuffle(X_test, y_test)
+            X_test, y_test = sklearn.utils.shuffle(
+                X_test, y_test, random_state=random_state
+            )
 
             # Exclude test bins from binned data
             X_train_0 = np.delete(X_binned_0, bin_idx, 0)
@@ -108,7 +131,9 @@ def decode_timeslice(X_all, trialinfo, decoding_task):
             )
 
             # Shuffle training data after bin creation
-            X_train, y_train = sklearn.utils.shuffle(X_train, y_train)
+            X_train, y_train = sklearn.utils.shuffle(
+                X_train, y_train, random_state=random_state
+            )
 
             # Fit model
             clf.fit(X_train, y_train)
@@ -116,15 +141,25 @@ def decode_timeslice(X_all, trialinfo, decoding_task):
             # Get accuracy
             acc.append(sklearn.metrics.accuracy_score(y_test, clf.predict(X_test)))
 
-            # Get feature importances
-            fmp.append(clf.feature_importances_)
+            # Add feature importances
+            if importance_method == "permutation":
+                fmp.add(
+                    importance.permutation_importances(
+                        clf,
+                        X_test,
+                        y_test,
+                        n_repeats=permutation_repeats,
+                        random_state=permutation_state,
+                    )
+                )
+            else:
+                fmp.add(clf.feature_importances_)
 
     # Average
     average_acc = np.stack(acc).mean(axis=0)
-    average_fmp = np.stack(fmp).mean(axis=0)
 
     # This is important!
-    return average_acc, average_fmp
+    return average_acc, fmp
 
 
 # Get list of dataset
@@ -139,46 +174,7 @@ for dataset_idx, dataset in enumerate(datasets):
     # Talk
     print(f"Decoding dataset {dataset_idx + 1} / {len(datasets)}.")
 
-    # Set sampling rate
-    srate = 200
-
-    # Read channel labels as list
-    channel_label_list = scipy.io.loadmat(os.path.join(path_in, "channel_labels.mat"))[
-        "channel_labels"
-    ][0].split(" ")[1:]
-
-    # Rename channels to match standard montage info of MNE
-    for x in range(len(channel_label_list)):
-        if channel_label_list[x] == "O9":
-            channel_label_list[x] = "OI1"
-        if channel_label_list[x] == "O10":
-            channel_label_list[x] = "OI2"
-
-    # Load epoch data
-    eeg_data = scipy.io.loadmat(dataset)["data"].transpose((2, 0, 1))
-
-    # Create info struct
-    eeg_info = mne.create_info(channel_label_list, srate)
-
-    # Create epoch struct
-    eeg_epochs = mne.EpochsArray(eeg_data, eeg_info, tmin=-1)
-
-    # Create channel type mapping
-    mapping = {}
-    for x in channel_label_list:
-        mapping[x] = "eeg"
-
-    # Apply mapping
-    eeg_epochs.set_channel_types(mapping)
-
-    # Set montage
-    montage = mne.channels.make_standard_montage("standard_1005")
-    eeg_epochs.set_montage(montage)
-
-    # Load trialinfo
-    trialinfo = scipy.io.loadmat(dataset)["trialinfo"]
-
-    # Get indices of channels to pick
+    # Channels to pick
     to_pick_labels = [
         "Fz",
         "F3",
@@ -201,197 +197,122 @@ for dataset_idx, dataset in enumerate(datasets):
         "PO7",
         "PO8",
     ]
-    to_pick_idx = [eeg_epochs.ch_names.index(x) for x in to_pick_labels]
 
-    # Perform single trial time-frequency analysis
+    # Time-frequency parameters
     n_freqs = 50
     tf_freqs = np.linspace(2, 30, n_freqs)
     tf_cycles = np.linspace(3, 12, n_freqs)
-    tf_epochs = mne.time_frequency.tfr_morlet(
-        eeg_epochs,
-        tf_freqs,
-        n_cycles=tf_cycles,
-        picks=to_pick_idx,
-        average=False,
-        return_itc=False,
-        n_jobs=-2,
-        decim=4,
-    )
-
-    # Save info object for plotting topos
-    info_object = tf_epochs.info
-
-    # Prune in time
-    to_keep_idx = (tf_epochs.times >= -0.6) & (tf_epochs.times <= 1.6)
-    tf_times = tf_epochs.times[to_keep_idx]
-    tf_data = tf_epochs.data[:, :, :, to_keep_idx]
 
-    # Average for frequency bands
-    tf_delta = tf_data[:, :, (tf_freqs >= 2) & (tf_freqs <= 3), :].mean(axis=2)
-    tf_theta = tf_data[:, :, (tf_freqs >= 4) & (tf_freqs <= 7), :].mean(axis=2)
-    tf_alpha = tf_data[:, :, (tf_freqs >= 8) & (tf_freqs <= 12), :].mean(axis=2)
-    tf_beta = tf_data[:, :, (tf_freqs >= 13) & (tf_freqs <= 31), :].mean(axis=2)
-
-    # Stacked data dims are freqband, trials, channnels, time
-    tf_data = np.stack((tf_delta, tf_theta, tf_alpha, tf_beta))
-
-    # Permute to trial x channel x freqs x time
-    tf_data = np.transpose(tf_data, (1, 2, 0, 3))
-
-    # Clean up
-    del eeg_epochs, tf_epochs, eeg_data
-
-    # Positions of target and distractor are coded  1-8, starting at the top-right position, then counting counter-clockwise
-
-    # Recode distractor and target positions in 4 bins 0-3 (c.f. https://www.nature.com/articles/s41598-019-45333-6)
-    # trialinfo[:, 19] = np.floor((trialinfo[:, 19] - 1) / 2)
-    # trialinfo[:, 20] = np.floor((trialinfo[:, 20] - 1) / 2)
-
-    # Recode distractor and target positions in 2 bins 0-1 (roughly left vs right...)
-    trialinfo[:, 20] = np.floor((trialinfo[:, 20] - 1) / 4)
-    trialinfo[:, 21] = np.floor((trialinfo[:, 21] - 1) / 4)
-
-    # Exclude trials: Practice-block trials and first-of-sequence trials and no-response trials
-    idx_to_keep = (
-        (trialinfo[:, 1] >= 5)
-        & (trialinfo[:, 22] > 1)
-        & ((trialinfo[:, 13] > -1) & (trialinfo[:, 13] < 2))
-    )
-    trialinfo = trialinfo[idx_to_keep, :]
-    tf_data = tf_data[idx_to_keep, :, :, :]
-
-    # get dims
-    n_trials, n_channels, n_freqs, _ = tf_data.shape
-
-    # Trialinfo cols:
-    # 00: id
-    # 01: block_nr
-    # 02: trial_nr
-    # 03: bonustrial
-    # 04: tilt_task
-    # 05: cue_ax
-    # 06: target_red_left
-    # 07: distractor_red_left
-    # 08: response_interference
-    # 09: task_switch
-    # 10: prev_switch
-    # 11: prev_accuracy
-    # 12: correct_response
-    # 13: response_side
-    # 14: rt
-    # 15: rt_thresh_color
-    # 16: rt_thresh_tilt
-    # 17: accuracy
-    # 18: position_color
-    # 19: position_tilt
-    # 20: position_target
-    # 21: position_distractor
-    # 22: sequence_position
-
-    # A list for stuff to classify
-    decoding_tasks = []
-
-    # Bonus decoding
-    decoding_tasks.append(
+    # Perform single trial time-frequency analysis in chunks of trials, or load it from
+    # cache. Data is trial x channel x band x time
+    tf_data, tf_times, info_object = tf_cache.load_or_compute(
+        path_cache,
+        dataset,
         {
-            "label": "bonus_vs_standard_in_repeat",
-            "trial_idx": trialinfo[:, 9] == 0,
-            "y_col": 3,
-        }
+            "picks": to_pick_labels,
+            "freqs": tf_freqs,
+            "n_cycles": tf_cycles,
+            "decim": 4,
+            "crop": (-0.6, 1.6),
+            "bands": tf_features.bands,
+            "method": "morlet",
+            "n_per_band": None,
+            "dtype": feature_dtype,
+        },
+        functools.partial(tf_features.streamed_band_power, chunk_size=tf_chunk_size),
+        streaming=True,
     )
 
-    decoding_tasks.append(
-        {
-            "label": "bonus_vs_standard_in_switch",
-            "trial_idx": trialinfo[:, 9] == 1,
-            "y_col": 3,
-        }
+    # Trialinfo of kept trials (recoded) and their trial numbers, see trial_filter.
+    # Cached next to the time-frequency data
+    trialinfo, trial_idx = trial_filter.load_or_compute(
+        path_cache,
+        dataset,
+        lambda dataset: trialinfo_schema.from_matrix(
+            eeglab_io.open_dataset(dataset).trialinfo
+        ),
     )
 
-    # Task decoding
-    decoding_tasks.append(
-        {
-            "label": "task_in_repeat_in_standard",
-            "trial_idx": (trialinfo[:, 9] == 0) & (trialinfo[:, 3] == 0),
-            "y_col": 4,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "task_in_repeat_in_bonus",
-            "trial_idx": (trialinfo[:, 9] == 0) & (trialinfo[:, 3] == 1),
-            "y_col": 4,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "task_in_switch_in_standard",
-            "trial_idx": (trialinfo[:, 9] == 1) & (trialinfo[:, 3] == 0),
-            "y_col": 4,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "task_in_switch_in_bonus",
-            "trial_idx": (trialinfo[:, 9] == 1) & (trialinfo[:, 3] == 1),
-            "y_col": 4,
-        }
+    # Trial masks of the decoding tasks, each distinct mask is computed once
+    compiled_tasks = task_specs.compile_tasks(trialinfo, tasks)
+    decoding_tasks = compiled_tasks.decoding_tasks()
+
+    # Re-arrange data. Time slices are read-only views of the temporally smoothed features
+    # of kept trials, memory-mapped from disk so that workers can share them
+    X_list = feature_provider.FeatureProvider(
+        tf_data,
+        tf_times,
+        memmap_file=os.path.join(path_shared, f"features_{id_string}.npy"),
+        temporal_smoothing=3,
+        trial_idx=trial_idx,
     )
+    tf_times = X_list.times
 
-    # Re-arrange data
-    X_list = []
-    temporal_smoothing = 3
-    tf_times = tf_times[: -(temporal_smoothing - 1)]
-    for time_idx, timeval in enumerate(tf_times):
-
-        # Data as trials x channels x frequencies. Apply a temporal smoothing
-        timepoint_data = tf_data[
-            :, :, :, time_idx : time_idx + temporal_smoothing
-        ].mean(axis=3)
+    # Clean up
+    del tf_data
 
-        # Trials in rows
-        timepoint_data_2d = timepoint_data.reshape((n_trials, n_channels * n_freqs))
+    # Open result store of the analysis. Metadata is stored once, at the first dataset
+    store = result_store.create(
+        os.path.join(path_out, "results"),
+        [decoding_task["label"] for decoding_task in decoding_tasks],
+        [x.split("VP")[1][0:2] for x in datasets],
+        tf_times,
+        importance_shape=(X_list.n_channels, X_list.n_bands),
+        freqs=tf_freqs,
+        bands=tf_features.bands,
+        info_object=info_object,
+        tasks=tasks,
+        importance_method=importance_method,
+    )
 
-        # Stack data
-        X_list.append(timepoint_data_2d)
+    # Workers read the time slices from the shared features file and only receive its name.
+    # Labels are implied by the resampling plans
+    features_file, _ = decoding_dispatch.share_inputs(
+        X_list, trialinfo, path_shared, id_string
+    )
 
-    # Clean up
-    del tf_data
+    # Draw undersampling plans once per task, shared by all time slices
+    plans = resampling.make_plans(
+        trialinfo,
+        decoding_tasks,
+        n_iterations=10,
+        seed=rng_streams.stream(random_seed, int(id_string)),
+    )
 
     # Iterate classification-tasks
     for decoding_task in decoding_tasks:
 
-        # Specify out file name for decoding task
-        out_file = os.path.join(
-            path_out, f"{decoding_task['label']}_{id_string}.joblib"
-        )
-
         # Check if done already. If so -> skip
-        if os.path.isfile(out_file):
+        if store.is_done(decoding_task["label"], id_string):
             continue
 
         # Fit random forest
         out = joblib.Parallel(n_jobs=-2)(
-            joblib.delayed(decode_timeslice)(X, trialinfo, decoding_task)
-            for X in X_list
+            joblib.delayed(decode_timeslice)(
+                features_file,
+                time_idx,
+                decoding_task,
+                plans[decoding_task["label"]],
+                rng_streams.stream(
+                    random_seed, int(id_string), decoding_task["label"], time_idx
+                ),
+                X_list.n_channels,
+                X_list.n_bands,
+            )
+            for time_idx in range(len(X_list))
         )
 
         # Stack accuracies
         acc = np.stack([x[0] for x in out])
 
-        # Stack feature importances (time x channel x frequencies)
-        fmp = np.stack([x[1].reshape((n_channels, n_freqs)) for x in out])
-
-        # Compile output
-        output = {
-            "id": id_string,
-            "decode_label": decoding_task["label"],
-            "times": tf_times,
-            "freqs": tf_freqs,
-            "acc": acc,
-            "fmp": fmp,
-            "info_object": info_object,
-        }
+        # Stack feature importances and their variance (time x channel x frequencies)
+        fmp, fmp_var = importance.stack([x[1] for x in out])
 
         # Save
-        joblib.dump(output, out_file)
+        store.write(decoding_task["label"], id_string, acc, fmp, fmp_var)
+
+    # Clean up shared features and trialinfo
+    del X_list
+    for file_name in (f"features_{id_string}.npy", f"trialinfo_{id_string}.npy"):
+        if os.path.isfile(os.path.join(path_shared, file_name)):
+            os.remove(os.path.join(path_shared, file_name))
@@ -2,177 +2,98 @@
 # -*- coding: utf-8 -*-
 
 # Imports
+import functools
 import glob
 import os
-import joblib
+import sys
 import numpy as np
-import sklearn.preprocessing
-import sklearn.model_selection
-import sklearn.metrics
-import sklearn.linear_model
-import mne
-import imblearn
-import scipy.io
-
-# Set environment variable so solve issue with parallel crash
-# https://stackoverflow.com/questions/40115043/no-space-left-on-device-error-while-fitting-sklearn-model/49154587#49154587
-os.environ["JOBLIB_TEMP_FOLDER"] = "/tmp"
+import eeglab_io
+import tf_cache
+import tf_features
+import decoding_dispatch
+import feature_provider
+import job_scheduler
+import executors
+import resampling
+import rng_streams
+import task_specs
+import trial_filter
+import result_store
+
+# Append repository root to sys path for the shared trialinfo schema
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import trialinfo_schema
 
 # Define paths
 path_in = "/mnt/data_dump/bocotilt/2_autocleaned/"
 path_out = "/mnt/data_dump/bocotilt/3_decoding_data/features_reduced_logreg_smoother_swirep_seperated/"
+path_cache = "/mnt/data_dump/bocotilt/3_decoding_data/tf_cache/"
+path_shared = "/mnt/data_dump/bocotilt/3_decoding_data/shared/"
 
-# Function that calls the classifications
-def decode_timeslice(X_all, trialinfo, decoding_task):
+# Set band-power method: "morlet" (all Morlet freqs, then band averages),
+# "wavelet" (fewer wavelets spread over each band) or "hilbert" (band-pass analytic signal)
+tf_method = "morlet"
 
-    # Select X and y data
-    X = X_all[decoding_task["trial_idx"], :]
-    y = trialinfo[decoding_task["trial_idx"], decoding_task["y_col"]]
+# Set numeric precision of features and decoding ("float32" halves memory and bandwidth)
+feature_dtype = "float32"
 
-    # Get dims
-    _, n_features = X.shape
+# Number of trials read and transformed at once. Bounds memory of the time-frequency analysis
+tf_chunk_size = 32
 
-    # Init undersampler
-    undersampler = imblearn.under_sampling.RandomUnderSampler(
-        sampling_strategy="not minority"
-    )
-
-    # Init classifier
-    clf = sklearn.linear_model.LogisticRegression()
-
-    # Set number of iterations
-    n_iterations = 50
-
-    # List for classifier performance and feature importances
-    acc = []
-
-    # Loop iterations
-    for _ in range(n_iterations):
-
-        # Undersample data
-        X_undersampled, y_undersampled = undersampler.fit_resample(X, y)
-
-        # Shuffle data after undersampling
-        X_undersampled, y_undersampled = sklearn.utils.shuffle(
-            X_undersampled, y_undersampled
-        )
-
-        # Scale data
-        scaler = sklearn.preprocessing.StandardScaler()
-        X_undersampled = scaler.fit_transform(X_undersampled)
+# Set classifier of the decoding engine ("logreg", "svm" or "lda")
+classifier = "logreg"
 
-        # Get data for both classes
-        X0 = X_undersampled[y_undersampled == 0, :]
-        X1 = X_undersampled[y_undersampled == 1, :]
+# Set to True to decode time x time generalization matrices
+temporal_generalization = False
 
-        # Set binsize
-        binsize = 15
+# Set number of undersampling iterations per task
+n_iterations = 50
 
-        # Determine number of bins
-        n_bins_per_class = int(np.floor(X0.shape[0] / binsize))
+# Set number of trials averaged per bin
+binsize = 15
 
-        # Arrays for bins
-        X_binned_0 = np.zeros((n_bins_per_class, n_features))
-        X_binned_1 = np.zeros((n_bins_per_class, n_features))
+# Set number of train times fitted at once in temporal generalization. Bounds memory
+generalization_chunk_size = 4
 
-        # Binning. Create ERPs
-        for row_idx, X_idx in enumerate(np.arange(0, X0.shape[0], binsize)[:-1]):
-            X_binned_0[row_idx, :] = X0[X_idx : X_idx + binsize, :].mean(axis=0)
-            X_binned_1[row_idx, :] = X1[X_idx : X_idx + binsize, :].mean(axis=0)
+# Base seed of all random draws. Streams are derived per subject, task, time slice and iteration
+random_seed = 42
 
-        # Iterate bins
-        for bin_idx in range(n_bins_per_class):
+# Decoding tasks as decoding target x factors of trial selection, see task_specs
+tasks = (
+    task_specs.declare("bonus_vs_standard", ["sequence"])
+    + task_specs.declare("task", ["sequence", "reward"])
+    + task_specs.declare("cue", ["sequence", "reward", "task"])
+    + task_specs.declare("response", ["sequence", "reward", "task"])
+    + task_specs.declare("target", ["sequence", "reward", "task"])
+    + task_specs.declare("distractor", ["sequence", "reward", "task"])
+)
 
-            # Get test data, one occurence of each class.
-            X_test = np.stack((X_binned_0[bin_idx, :], X_binned_1[bin_idx, :]))
+# Set number of time points per job unit and number of units decoded at once.
+# Finished units are recorded in path_jobs, so an interrupted run resumes there. Records
+# are keyed by a hash of the analysis setup, so changed settings are decoded anew
+chunk_size = 16
+n_concurrent = -2
+analysis_mode = "generalization" if temporal_generalization else "timecourse"
+path_jobs = os.path.join(path_out, f"jobs_{classifier}_{random_seed}_{analysis_mode}")
 
-            # Get test labels
-            y_test = np.array((0, 1))
+# Results are stored per classifier, seed and decoding mode, like the job records
+path_results = os.path.join(
+    path_out, f"results_{classifier}_{random_seed}_{analysis_mode}"
+)
 
-            # Shuffle test data
-            X_test, y_test = sklearn.utils.shuffle(X_test, y_test)
+# Set executor of job units. To decode on several machines, use a queue on the shared
+# file system and start "python executors.py <path_queue>" on each machine, e.g.
+# executor = executors.FileQueueExecutor("/mnt/data_dump/bocotilt/3_decoding_data/queue/")
+executor = executors.LocalExecutor(n_jobs=n_concurrent)
 
-            # Exclude test bins from binned data
-            X_train_0 = np.delete(X_binned_0, bin_idx, 0)
-            X_train_1 = np.delete(X_binned_1, bin_idx, 0)
 
-            # Concatenate bins to training dataset
-            X_train = np.concatenate((X_train_0, X_train_1), axis=0)
-
-            # Create label vector
-            y_train = np.concatenate(
-                (np.zeros((n_bins_per_class - 1,)), np.ones((n_bins_per_class - 1,))),
-                axis=0,
-            )
-
-            # Shuffle training data after bin creation
-            X_train, y_train = sklearn.utils.shuffle(X_train, y_train)
-
-            # Fit model
-            clf.fit(X_train, y_train)
-
-            # Get accuracy
-            acc.append(sklearn.metrics.accuracy_score(y_test, clf.predict(X_test)))
-
-    # Average
-    average_acc = np.stack(acc).mean(axis=0)
-
-    # This is important!
-    return average_acc
-
-
-# Get list of dataset
-datasets = glob.glob(f"{path_in}/*cleaned.set")
-
-# Iterate preprocessed datasets
-for dataset_idx, dataset in enumerate(datasets):
+# Function that loads a dataset and prepares features, trialinfo and decoding tasks
+def prepare_dataset(dataset):
 
     # Get subject id as string
     id_string = dataset.split("VP")[1][0:2]
 
-    # Talk
-    print(f"Decoding dataset {dataset_idx + 1} / {len(datasets)}.")
-
-    # Set sampling rate
-    srate = 200
-
-    # Read channel labels as list
-    channel_label_list = scipy.io.loadmat(os.path.join(path_in, "channel_labels.mat"))[
-        "channel_labels"
-    ][0].split(" ")[1:]
-
-    # Rename channels to match standard montage info of MNE
-    for x in range(len(channel_label_list)):
-        if channel_label_list[x] == "O9":
-            channel_label_list[x] = "OI1"
-        if channel_label_list[x] == "O10":
-            channel_label_list[x] = "OI2"
-
-    # Load epoch data
-    eeg_data = scipy.io.loadmat(dataset)["data"].transpose((2, 0, 1))
-
-    # Create info struct
-    eeg_info = mne.create_info(channel_label_list, srate)
-
-    # Create epoch struct
-    eeg_epochs = mne.EpochsArray(eeg_data, eeg_info, tmin=-1)
-
-    # Create channel type mapping
-    mapping = {}
-    for x in channel_label_list:
-        mapping[x] = "eeg"
-
-    # Apply mapping
-    eeg_epochs.set_channel_types(mapping)
-
-    # Set montage
-    montage = mne.channels.make_standard_montage("standard_1005")
-    eeg_epochs.set_montage(montage)
-
-    # Load trialinfo
-    trialinfo = scipy.io.loadmat(dataset)["trialinfo"]
-
-    # Get indices of channels to pick
+    # Channels to pick
     to_pick_labels = [
         "Fz",
         "F3",
@@ -195,485 +116,184 @@ for dataset_idx, dataset in enumerate(datasets):
         "PO7",
         "PO8",
     ]
-    to_pick_idx = [eeg_epochs.ch_names.index(x) for x in to_pick_labels]
 
-    # Perform single trial time-frequency analysis
+    # Time-frequency parameters
     n_freqs = 50
     tf_freqs = np.linspace(2, 30, n_freqs)
     tf_cycles = np.linspace(3, 12, n_freqs)
-    tf_epochs = mne.time_frequency.tfr_morlet(
-        eeg_epochs,
-        tf_freqs,
-        n_cycles=tf_cycles,
-        picks=to_pick_idx,
-        average=False,
-        return_itc=False,
-        n_jobs=-2,
-        decim=2,
-    )
-
-    # Save info object for plotting topos
-    info_object = tf_epochs.info
 
-    # Prune in time
-    to_keep_idx = (tf_epochs.times >= -0.2) & (tf_epochs.times <= 1.4)
-    tf_times = tf_epochs.times[to_keep_idx]
-    tf_data = tf_epochs.data[:, :, :, to_keep_idx]
-
-    # Average for frequency bands
-    tf_delta = tf_data[:, :, (tf_freqs >= 2) & (tf_freqs <= 3), :].mean(axis=2)
-    tf_theta = tf_data[:, :, (tf_freqs >= 4) & (tf_freqs <= 7), :].mean(axis=2)
-    tf_alpha = tf_data[:, :, (tf_freqs >= 8) & (tf_freqs <= 12), :].mean(axis=2)
-    tf_beta = tf_data[:, :, (tf_freqs >= 13) & (tf_freqs <= 31), :].mean(axis=2)
-
-    # Stacked data dims are freqband, trials, channnels, time
-    tf_data = np.stack((tf_delta, tf_theta, tf_alpha, tf_beta))
-
-    # Permute to trial x channel x freqs x time
-    tf_data = np.transpose(tf_data, (1, 2, 0, 3))
-
-    # Clean up
-    del eeg_epochs, tf_epochs, eeg_data
-
-    # Positions of target and distractor are coded  1-8, starting at the top-right position, then counting counter-clockwise
-
-    # Recode distractor and target positions in 4 bins 0-3 (c.f. https://www.nature.com/articles/s41598-019-45333-6)
-    # trialinfo[:, 19] = np.floor((trialinfo[:, 19] - 1) / 2)
-    # trialinfo[:, 20] = np.floor((trialinfo[:, 20] - 1) / 2)
-
-    # Recode distractor and target positions in 2 bins 0-1 (roughly left vs right...)
-    trialinfo[:, 20] = np.floor((trialinfo[:, 20] - 1) / 4)
-    trialinfo[:, 21] = np.floor((trialinfo[:, 21] - 1) / 4)
-
-    # Exclude trials: Practice-block trials and first-of-sequence trials and no-response trials
-    idx_to_keep = (
-        (trialinfo[:, 1] >= 5)
-        & (trialinfo[:, 22] > 1)
-        & ((trialinfo[:, 13] > -1) & (trialinfo[:, 13] < 2))
-    )
-    trialinfo = trialinfo[idx_to_keep, :]
-    tf_data = tf_data[idx_to_keep, :, :, :]
-
-    # get dims
-    n_trials, n_channels, n_freqs, _ = tf_data.shape
-
-    # Trialinfo cols:
-    # 00: id
-    # 01: block_nr
-    # 02: trial_nr
-    # 03: bonustrial
-    # 04: tilt_task
-    # 05: cue_ax
-    # 06: target_red_left
-    # 07: distractor_red_left
-    # 08: response_interference
-    # 09: task_switch
-    # 10: prev_switch
-    # 11: prev_accuracy
-    # 12: correct_response
-    # 13: response_side
-    # 14: rt
-    # 15: rt_thresh_color
-    # 16: rt_thresh_tilt
-    # 17: accuracy
-    # 18: position_color
-    # 19: position_tilt
-    # 20: position_target
-    # 21: position_distractor
-    # 22: sequence_position
-
-    # A list for stuff to classify
-    decoding_tasks = []
-
-    # Bonus decoding
-    decoding_tasks.append(
-        {
-            "label": "bonus_vs_standard_in_repeat",
-            "trial_idx": trialinfo[:, 9] == 0,
-            "y_col": 3,
-        }
-    )
-
-    decoding_tasks.append(
-        {
-            "label": "bonus_vs_standard_in_switch",
-            "trial_idx": trialinfo[:, 9] == 1,
-            "y_col": 3,
-        }
-    )
-
-    # Task decoding
-    decoding_tasks.append(
-        {
-            "label": "task_in_repeat_in_standard",
-            "trial_idx": (trialinfo[:, 9] == 0) & (trialinfo[:, 3] == 0),
-            "y_col": 4,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "task_in_repeat_in_bonus",
-            "trial_idx": (trialinfo[:, 9] == 0) & (trialinfo[:, 3] == 1),
-            "y_col": 4,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "task_in_switch_in_standard",
-            "trial_idx": (trialinfo[:, 9] == 1) & (trialinfo[:, 3] == 0),
-            "y_col": 4,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "task_in_switch_in_bonus",
-            "trial_idx": (trialinfo[:, 9] == 1) & (trialinfo[:, 3] == 1),
-            "y_col": 4,
-        }
-    )
-
-    # Cue decoding
-    decoding_tasks.append(
-        {
-            "label": "cue_in_repeat_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 5,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "cue_in_repeat_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 5,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "cue_in_repeat_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 5,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "cue_in_repeat_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 5,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "cue_in_switch_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 5,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "cue_in_switch_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 5,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "cue_in_switch_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 5,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "cue_in_switch_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 5,
-        }
-    )
-
-    # Response decoding
-    decoding_tasks.append(
-        {
-            "label": "response_in_repeat_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 13,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "response_in_repeat_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 13,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "response_in_repeat_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 13,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "response_in_repeat_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 13,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "response_in_switch_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 13,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "response_in_switch_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 13,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "response_in_switch_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 13,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "response_in_switch_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 13,
-        }
+    # Perform single trial time-frequency analysis in chunks of trials, or load it from
+    # cache. Data is trial x channel x band x time
+    tf_params = {
+        "picks": to_pick_labels,
+        "freqs": tf_freqs,
+        "n_cycles": tf_cycles,
+        "decim": 2,
+        "crop": (-0.2, 1.4),
+        "bands": tf_features.bands,
+        "method": tf_method,
+        "n_per_band": None,
+        "dtype": feature_dtype,
+    }
+    tf_data, tf_times, info_object = tf_cache.load_or_compute(
+        path_cache,
+        dataset,
+        tf_params,
+        functools.partial(tf_features.streamed_band_power, chunk_size=tf_chunk_size),
+        streaming=True,
+    )
+
+    # Trialinfo of kept trials (recoded) and their trial numbers, see trial_filter.
+    # Cached next to the time-frequency data
+    trialinfo, trial_idx = trial_filter.load_or_compute(
+        path_cache,
+        dataset,
+        lambda dataset: trialinfo_schema.from_matrix(
+            eeglab_io.open_dataset(dataset).trialinfo
+        ),
+    )
+
+    # Trial masks of the decoding tasks, each distinct mask is computed once
+    compiled_tasks = task_specs.compile_tasks(trialinfo, tasks)
+    decoding_tasks = compiled_tasks.decoding_tasks()
+
+    # Re-arrange data. Time slices are read-only views of the temporally smoothed features
+    # of kept trials, memory-mapped from disk so that workers can share them
+    temporal_smoothing = 3
+    X_list = feature_provider.FeatureProvider(
+        tf_data,
+        tf_times,
+        temporal_smoothing=temporal_smoothing,
+        memmap_file=os.path.join(path_shared, f"features_{id_string}.npy"),
+        trial_idx=trial_idx,
     )
+    tf_times = X_list.times
 
-    # Target decoding
-    decoding_tasks.append(
-        {
-            "label": "target_in_repeat_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 20,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "target_in_repeat_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 20,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "target_in_repeat_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 20,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "target_in_repeat_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 20,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "target_in_switch_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 20,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "target_in_switch_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 20,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "target_in_switch_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 20,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "target_in_switch_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 20,
-        }
-    )
+    # Clean up
+    del tf_data
 
-    # Distractor decoding
-    decoding_tasks.append(
-        {
-            "label": "distractor_in_repeat_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 21,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "distractor_in_repeat_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 21,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "distractor_in_repeat_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 21,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "distractor_in_repeat_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 0)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 21,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "distractor_in_switch_in_standard_in_color",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 21,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "distractor_in_switch_in_standard_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 0)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 21,
-        }
-    )
-    decoding_tasks.append(
-        {
-            "label": "distractor_in_switch_in_bonus_in_color",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 0),
-            "y_col": 21,
-        }
-    )
-    decoding_tasks.append(
+    # Hash of the features and trial selection, for the job records
+    features_key = tf_cache.cache_key(
+        tf_cache.entry_key(path_cache, dataset, tf_params),
         {
-            "label": "distractor_in_switch_in_bonus_in_tilt",
-            "trial_idx": (trialinfo[:, 9] == 1)
-            & (trialinfo[:, 3] == 1)
-            & (trialinfo[:, 4] == 1),
-            "y_col": 21,
-        }
+            "temporal_smoothing": temporal_smoothing,
+            "trial_filter": trial_filter.default_params,
+        },
     )
 
-    # Re-arrange data
-    X_list = []
-    temporal_smoothing = 3
-    tf_times = tf_times[: -(temporal_smoothing - 1)]
-    for time_idx, timeval in enumerate(tf_times):
-
-        # Data as trials x channels x frequencies. Apply a temporal smoothing
-        timepoint_data = tf_data[
-            :, :, :, time_idx : time_idx + temporal_smoothing
-        ].mean(axis=3)
+    return {
+        "id": id_string,
+        "X_list": X_list,
+        "trialinfo": trialinfo,
+        "decoding_tasks": decoding_tasks,
+        "compiled_tasks": compiled_tasks,
+        "tf_times": tf_times,
+        "tf_freqs": tf_freqs,
+        "info_object": info_object,
+        "features_key": features_key,
+    }
 
-        # Trials in rows
-        timepoint_data_2d = timepoint_data.reshape((n_trials, n_channels * n_freqs))
 
-        # Stack data
-        X_list.append(timepoint_data_2d)
-
-    # Clean up
-    del tf_data
+# Get list of dataset
+datasets = glob.glob(f"{path_in}/*cleaned.set")
 
-    # Iterate classification-tasks
-    for decoding_task in decoding_tasks:
+# Iterate preprocessed datasets. The next dataset is prepared while the current one decodes
+for dataset_idx, prepared in enumerate(
+    job_scheduler.prefetch(datasets, prepare_dataset)
+):
 
-        # Specify out file name for decoding task
-        out_file = os.path.join(
-            path_out, f"{decoding_task['label']}_{id_string}.joblib"
-        )
+    # Talk
+    print(f"Decoding dataset {dataset_idx + 1} / {len(datasets)}.")
 
-        # Fit random forest
-        out = joblib.Parallel(n_jobs=-2)(
-            joblib.delayed(decode_timeslice)(X, trialinfo, decoding_task)
-            for X in X_list
+    # Unpack prepared dataset
+    id_string = prepared["id"]
+    X_list = prepared["X_list"]
+    trialinfo = prepared["trialinfo"]
+    decoding_tasks = prepared["decoding_tasks"]
+    compiled_tasks = prepared["compiled_tasks"]
+    tf_times = prepared["tf_times"]
+    tf_freqs = prepared["tf_freqs"]
+    info_object = prepared["info_object"]
+
+    # Hash of the analysis setup of this subject. Job records of other setups are not reused
+    setup_key = tf_cache.cache_key(
+        prepared["features_key"],
+        {
+            "tasks": tasks,
+            "n_iterations": n_iterations,
+            "binsize": binsize,
+            "generalization_chunk_size": generalization_chunk_size,
+            "random_seed": random_seed,
+            "classifier": classifier,
+            "mode": analysis_mode,
+        },
+    )
+
+    # Open result store of the analysis before decoding, so that a store with a different
+    # layout fails early. Metadata is stored once, at the first dataset
+    store = result_store.create(
+        path_results,
+        [decoding_task["label"] for decoding_task in decoding_tasks],
+        [x.split("VP")[1][0:2] for x in datasets],
+        tf_times,
+        temporal_generalization=temporal_generalization,
+        freqs=tf_freqs,
+        bands=tf_features.bands,
+        info_object=info_object,
+        tasks=tasks,
+    )
+
+    # Group classification-tasks by trial selection (tasks with the same compiled mask)
+    task_groups = compiled_tasks.task_groups(decoding_tasks)
+
+    # Draw undersampling plans once per task, shared by all time slices
+    subject_seed = rng_streams.stream(random_seed, int(id_string))
+    plans = resampling.make_plans(
+        trialinfo, decoding_tasks, n_iterations=n_iterations, seed=subject_seed
+    )
+
+    # Decode in units of task group and chunk of time points (train times in temporal
+    # generalization). Workers read the shared files, units recorded in an earlier run
+    # are skipped
+    features_file, trialinfo_file = decoding_dispatch.share_inputs(
+        X_list, trialinfo, path_shared, id_string
+    )
+    units = job_scheduler.make_units(
+        id_string,
+        [
+            decoding_dispatch.compact_task_group(task_group, plans)
+            for task_group in task_groups
+        ],
+        len(X_list),
+        chunk_size,
+        setup=setup_key,
+    )
+    if temporal_generalization:
+        decode_chunk = functools.partial(
+            decoding_dispatch.decode_group_generalization_chunk,
+            chunk_size=generalization_chunk_size,
         )
+    else:
+        decode_chunk = decoding_dispatch.decode_group_chunk
+    job_scheduler.run_units(
+        decode_chunk,
+        units,
+        path_jobs,
+        executor=executor,
+        features_file=features_file,
+        trialinfo_file=trialinfo_file,
+        classifier=classifier,
+        seed=subject_seed,
+        binsize=binsize,
+    )
+    accs = job_scheduler.collect_units(units, path_jobs, len(X_list))
+
+    # Save accuracies of classification-tasks
+    for decoding_task in decoding_tasks:
+        store.write(decoding_task["label"], id_string, accs[decoding_task["label"]])
 
-        # Stack accuracies
-        acc = np.stack([x for x in out])
-
-        # Compile output
-        output = {
-            "id": id_string,
-            "decode_label": decoding_task["label"],
-            "times": tf_times,
-            "freqs": tf_freqs,
-            "acc": acc,
-            "info_object": info_object,
-        }
-
-        # Save
-        joblib.dump(output, out_file)
+    # Clean up shared features and trialinfo
+    del X_list, prepared
+    for file_name in (f"features_{id_string}.npy", f"trialinfo_{id_string}.npy"):
+        if os.path.isfile(os.path.join(path_shared, file_name)):
+            os.remove(os.path.join(path_shared, file_name))
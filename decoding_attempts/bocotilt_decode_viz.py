@@ -7,102 +7,37 @@ Created on Fri Mar  3 15:56:12 2023
 """
 
 # Imports
-import glob
 import os
-import joblib
 import numpy as np
 import mne
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+import results_query
+import cluster_stats
 
+# Set length and time labels of moving average windows: "start" labels a window with its
+# first time point, as the baseline plots did. "causal" (last time point) or "centred"
+# (window centre) shift all plotted times by smoothing_length - 1 or half of it
+smoothing_mode = "start"
 smoothing_length = 5
 
-# For smoothing...
-def moving_average(x, w=smoothing_length):
-    return np.convolve(x, np.ones(w), 'valid') / w
-
 # Path vars
 path_in = "/mnt/data_dump/bocotilt/3_decoding_data/features_reduced/"
 
-# Define labels to load
-labels = [
-    "bonus_vs_standard",
-    "task_in_bonus",
-    "task_in_standard",
-    "cue_in_standard_in_color",
-    "cue_in_standard_in_tilt",
-    "cue_in_bonus_in_color",
-    "cue_in_bonus_in_tilt",
-    "response_in_standard_in_color",
-    "response_in_standard_in_tilt",
-    "response_in_bonus_in_color",
-    "response_in_bonus_in_tilt",
-    "target_in_standard_in_color",
-    "target_in_standard_in_tilt",
-    "target_in_bonus_in_color",
-    "target_in_bonus_in_tilt",
-    "distractor_in_standard_in_color",
-    "distractor_in_standard_in_tilt",
-    "distractor_in_bonus_in_color",
-    "distractor_in_bonus_in_tilt",
-]
-
-# Result collectors
-accs = {}
-accs_butterfly = {}
-
-# Loop labels
-for label in labels:
-
-    # Get label datasets
-    datasets = glob.glob(f"{path_in}/{label}*.joblib")
-
-    # List for decoding task data
-    acc = []
-    acc_buttrefly = []
-
-    # Loop datasets
-    for dataset in datasets:
-
-        # Load datasets
-        data = joblib.load(dataset)
-
-        # Get dim vectors
-        times = data["times"]
-        chan_info = data["info_object"]
-        
-        # Adjust times
-        times = times[:-(smoothing_length-1)]
-
-        # Get dims
-        n_times, n_chans = (
-            len(data["times"]),
-            len(data["info_object"].ch_names),
-        )
-        
-        # Smooth data
-        acc_smoothed = moving_average(data["acc"])
-        
-        # Collect data
-        acc.append(acc_smoothed)
-        acc_buttrefly.append(acc_smoothed)
-
-    # Stack data
-    acc = np.stack(acc)
-
-    # Save acc data for butterfly
-    accs_butterfly[label] = np.stack(acc)
-
-    # Average data
-    accs[label] = np.stack(acc).mean(axis=0)
-    
-    
-    
-    
-    
+# Query results of the analysis. Data is read once, aggregates are computed on first use
+query = results_query.ResultsQuery(os.path.join(path_in, "results"))
+
+# Get dim vectors of smoothed data
+times = query.times(smoothing_length, smoothing_mode)
+chan_info = query.info_object
+
+# Group averages and per-subject data (for butterfly plots and tests) of smoothed accuracies
+accs = query.aggregates("mean", smoothing_length, smoothing_mode)
+accs_butterfly = query.aggregates("subjects", smoothing_length, smoothing_mode)
+
 # Define adjacency matrix
 adjacency, channel_names = mne.channels.find_ch_adjacency(
-    data["info_object"], ch_type="eeg"
+    chan_info, ch_type="eeg"
 )
 
 
@@ -121,9 +56,8 @@ data_1 = accs_butterfly["bonus_vs_standard"]
 data_2 = np.zeros(accs_butterfly["bonus_vs_standard"].shape) + 0.5
 
 threshold = 1.0
-T_obs, clusters, cluster_p_values, H0 = mne.stats.permutation_cluster_test([data_1, data_2], n_permutations=1000,
-                             threshold=threshold, tail=1, n_jobs=None,
-                             out_type='mask')
+T_obs, clusters, cluster_p_values, H0 = cluster_stats.permutation_cluster_test([data_1, data_2], n_permutations=1000,
+                             threshold=threshold, tail=1, seed=42)
 
 
 fig, (ax, ax2) = plt.subplots(2, 1, figsize=(8, 4))
@@ -134,12 +68,12 @@ ax.set_ylabel("acc")
 ax.legend()
 
 for i_c, c in enumerate(clusters):
-    c = c[0]
+    c = times[c]
     if cluster_p_values[i_c] <= 0.05:
-        h = ax2.axvspan(times[c.start], times[c.stop - 1],
+        h = ax2.axvspan(c[0], c[-1],
                         color='r', alpha=0.3)
     else:
-        ax2.axvspan(times[c.start], times[c.stop - 1], color=(0.3, 0.3, 0.3),
+        ax2.axvspan(c[0], c[-1], color=(0.3, 0.3, 0.3),
                     alpha=0.3)
 
 hf = plt.plot(times, T_obs, 'g')
@@ -165,9 +99,8 @@ data_1 = accs_butterfly["task_in_bonus"]
 data_2 = accs_butterfly["task_in_standard"] 
 
 threshold = 1.0
-T_obs, clusters, cluster_p_values, H0 = mne.stats.permutation_cluster_test([data_1, data_2], n_permutations=1000,
-                             threshold=threshold, tail=1, n_jobs=None,
-                             out_type='mask')
+T_obs, clusters, cluster_p_values, H0 = cluster_stats.permutation_cluster_test([data_1, data_2], n_permutations=1000,
+                             threshold=threshold, tail=1, seed=42)
 
 
 fig, (ax, ax2) = plt.subplots(2, 1, figsize=(8, 4))
@@ -178,12 +111,12 @@ ax.set_ylabel("acc")
 ax.legend()
 
 for i_c, c in enumerate(clusters):
-    c = c[0]
+    c = times[c]
     if cluster_p_values[i_c] <= 0.05:
-        h = ax2.axvspan(times[c.start], times[c.stop - 1],
+        h = ax2.axvspan(c[0], c[-1],
                         color='r', alpha=0.3)
     else:
-        ax2.axvspan(times[c.start], times[c.stop - 1], color=(0.3, 0.3, 0.3),
+        ax2.axvspan(c[0], c[-1], color=(0.3, 0.3, 0.3),
                     alpha=0.3)
 
 hf = plt.plot(times, T_obs, 'g')
@@ -7,120 +7,39 @@ Created on Fri Mar  3 15:56:12 2023
 """
 
 # Imports
-import glob
 import os
-import joblib
-import numpy as np
 import mne
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+import results_query
+import stats_runner
 
+# Set length and time labels of moving average windows: "start" labels a window with its
+# first time point, as the baseline plots did. "causal" (last time point) or "centred"
+# (window centre) shift all plotted times by smoothing_length - 1 or half of it
+smoothing_mode = "start"
 smoothing_length = 2
 
-# For smoothing...
-def moving_average(x, w=smoothing_length):
-    return np.convolve(x, np.ones(w), "valid") / w
-
 
 # Path vars
 path_in = "/mnt/data_dump/bocotilt/3_decoding_data/features_reduced_logreg_smoother_swirep_seperated/"
 
-# Define labels to load
-labels = [
-    "bonus_vs_standard_in_repeat",
-    "bonus_vs_standard_in_switch",
-    "task_in_repeat_in_standard",
-    "task_in_repeat_in_bonus",
-    "task_in_switch_in_standard",
-    "task_in_switch_in_bonus",
-    "cue_in_repeat_in_standard_in_color",
-    "cue_in_repeat_in_bonus_in_color",
-    "cue_in_switch_in_standard_in_color",
-    "cue_in_switch_in_bonus_in_color",
-    "cue_in_repeat_in_standard_in_tilt",
-    "cue_in_repeat_in_bonus_in_tilt",
-    "cue_in_switch_in_standard_in_tilt",
-    "cue_in_switch_in_bonus_in_tilt",
-    "response_in_repeat_in_standard_in_color",
-    "response_in_repeat_in_bonus_in_color",
-    "response_in_switch_in_standard_in_color",
-    "response_in_switch_in_bonus_in_color",
-    "response_in_repeat_in_standard_in_tilt",
-    "response_in_repeat_in_bonus_in_tilt",
-    "response_in_switch_in_standard_in_tilt",
-    "response_in_switch_in_bonus_in_tilt",
-    "target_in_repeat_in_standard_in_color",
-    "target_in_repeat_in_bonus_in_color",
-    "target_in_switch_in_standard_in_color",
-    "target_in_switch_in_bonus_in_color",
-    "target_in_repeat_in_standard_in_tilt",
-    "target_in_repeat_in_bonus_in_tilt",
-    "target_in_switch_in_standard_in_tilt",
-    "target_in_switch_in_bonus_in_tilt",
-    "distractor_in_repeat_in_standard_in_color",
-    "distractor_in_repeat_in_bonus_in_color",
-    "distractor_in_switch_in_standard_in_color",
-    "distractor_in_switch_in_bonus_in_color",
-    "distractor_in_repeat_in_standard_in_tilt",
-    "distractor_in_repeat_in_bonus_in_tilt",
-    "distractor_in_switch_in_standard_in_tilt",
-    "distractor_in_switch_in_bonus_in_tilt",
-]
-
-# Result collectors
-accs = {}
-accs_butterfly = {}
-
-# Loop labels
-for label in labels:
-
-    # Get label datasets
-    datasets = glob.glob(f"{path_in}/{label}*.joblib")
-
-    # List for decoding task data
-    acc = []
-    acc_buttrefly = []
-
-    # Loop datasets
-    for dataset in datasets:
-
-        # Load datasets
-        data = joblib.load(dataset)
-
-        # Get dim vectors
-        times = data["times"]
-        chan_info = data["info_object"]
-
-        # Adjust times
-        times = times[: -(smoothing_length - 1)]
-
-        # Get dims
-        n_times, n_chans = (
-            len(data["times"]),
-            len(data["info_object"].ch_names),
-        )
-
-        # Smooth data
-        acc_smoothed = moving_average(data["acc"])
-
-        # Collect data
-        acc.append(acc_smoothed)
-        acc_buttrefly.append(acc_smoothed)
-
-    # Stack data
-    acc = np.stack(acc)
+# Query results of the analysis. Data is read once, aggregates are computed on first use
+query = results_query.ResultsQuery(
+    os.path.join(path_in, "results_logreg_42_timecourse")
+)
 
-    # Save acc data for butterfly
-    accs_butterfly[label] = np.stack(acc)
+# Get dim vectors of smoothed data
+times = query.times(smoothing_length, smoothing_mode)
+chan_info = query.info_object
 
-    # Average data
-    accs[label] = np.stack(acc).mean(axis=0)
+# Group averages and per-subject data (for butterfly plots and tests) of smoothed accuracies
+accs = query.aggregates("mean", smoothing_length, smoothing_mode)
+accs_butterfly = query.aggregates("subjects", smoothing_length, smoothing_mode)
 
 
 # Define adjacency matrix
-adjacency, channel_names = mne.channels.find_ch_adjacency(
-    data["info_object"], ch_type="eeg"
-)
+adjacency, channel_names = mne.channels.find_ch_adjacency(chan_info, ch_type="eeg")
 
 
 # Plot bonus decoding
@@ -173,134 +92,44 @@ tests.append(
     }
 )
 
+# Perform tests in parallel. Results are cached, reruns only test changed contrasts
+results = stats_runner.run_contrasts(
+    tests,
+    os.path.join(path_in, "stats_cache"),
+    threshold=3.0,
+    n_permutations=5000,
+    tail=0,
+)
+
 # Iterate tests
-for test in tests:
+for test, result in zip(tests, results):
 
-    # Perform test
-    T_obs, clusters, cluster_p_values, H0 = mne.stats.permutation_cluster_test(
-        [test["data1"], test["data2"]],
-        n_permutations=5000,
-        threshold=3.0,
-        tail=0,
-        n_jobs=None,
-        out_type="mask",
-    )
+    # Get results
+    clusters, cluster_p_values = result["clusters"], result["cluster_p_values"]
 
     # Get significant clusters
     test["n_clusters"] = len(clusters)
     for cluster_idx, cluster in enumerate(clusters):
         print(cluster_p_values[cluster_idx])
-        cluster = cluster[0]
+        cluster_times = times[cluster]
         if cluster_p_values[cluster_idx] <= 0.1:
-            h = ax.axvspan(
-                times[cluster.start], times[cluster.stop - 1], color="r", alpha=0.3
-            )
+            h = ax.axvspan(cluster_times[0], cluster_times[-1], color="r", alpha=0.3)
 
 # Show figure
 fig.show()
 
 
-# Plot cue decoding
-fig = plt.figure()
-pd = (
-    accs["cue_in_repeat_in_standard_in_color"]
-    + accs["cue_in_repeat_in_standard_in_tilt"]
-) / 2
-plt.plot(times, pd, label="rep-std")
-pd = (
-    accs["cue_in_repeat_in_bonus_in_color"] + accs["cue_in_repeat_in_bonus_in_tilt"]
-) / 2
-plt.plot(times, pd, label="rep-bon")
-pd = (
-    accs["cue_in_switch_in_standard_in_color"]
-    + accs["cue_in_switch_in_standard_in_tilt"]
-) / 2
-plt.plot(times, pd, label="swi-std")
-pd = (
-    accs["cue_in_switch_in_bonus_in_color"] + accs["cue_in_switch_in_bonus_in_tilt"]
-) / 2
-plt.plot(times, pd, label="swi-bon")
-plt.legend()
-plt.title("cue decoding")
-fig.show()
-
-
-# Plot response decoding
-fig = plt.figure()
-pd = (
-    accs["response_in_repeat_in_standard_in_color"]
-    + accs["response_in_repeat_in_standard_in_tilt"]
-) / 2
-plt.plot(times, pd, label="rep-std")
-pd = (
-    accs["response_in_repeat_in_bonus_in_color"]
-    + accs["response_in_repeat_in_bonus_in_tilt"]
-) / 2
-plt.plot(times, pd, label="rep-bon")
-pd = (
-    accs["response_in_switch_in_standard_in_color"]
-    + accs["response_in_switch_in_standard_in_tilt"]
-) / 2
-plt.plot(times, pd, label="swi-std")
-pd = (
-    accs["response_in_switch_in_bonus_in_color"]
-    + accs["response_in_switch_in_bonus_in_tilt"]
-) / 2
-plt.plot(times, pd, label="swi-bon")
-plt.legend()
-plt.title("response decoding")
-fig.show()
-
-
-# Plot target decoding
-fig = plt.figure()
-pd = (
-    accs["target_in_repeat_in_standard_in_color"]
-    + accs["target_in_repeat_in_standard_in_tilt"]
-) / 2
-plt.plot(times, pd, label="rep-std")
-pd = (
-    accs["target_in_repeat_in_bonus_in_color"]
-    + accs["target_in_repeat_in_bonus_in_tilt"]
-) / 2
-plt.plot(times, pd, label="rep-bon")
-pd = (
-    accs["target_in_switch_in_standard_in_color"]
-    + accs["target_in_switch_in_standard_in_tilt"]
-) / 2
-plt.plot(times, pd, label="swi-std")
-pd = (
-    accs["target_in_switch_in_bonus_in_color"]
-    + accs["target_in_switch_in_bonus_in_tilt"]
-) / 2
-plt.plot(times, pd, label="swi-bon")
-plt.legend()
-plt.title("target decoding")
-fig.show()
-
-
-# Plot distractor decoding
-fig = plt.figure()
-pd = (
-    accs["distractor_in_repeat_in_standard_in_color"]
-    + accs["distractor_in_repeat_in_standard_in_tilt"]
-) / 2
-plt.plot(times, pd, label="rep-std")
-pd = (
-    accs["distractor_in_repeat_in_bonus_in_color"]
-    + accs["distractor_in_repeat_in_bonus_in_tilt"]
-) / 2
-plt.plot(times, pd, label="rep-bon")
-pd = (
-    accs["distractor_in_switch_in_standard_in_color"]
-    + accs["distractor_in_switch_in_standard_in_tilt"]
-) / 2
-plt.plot(times, pd, label="swi-std")
-pd = (
-    accs["distractor_in_switch_in_bonus_in_color"]
-    + accs["distractor_in_switch_in_bonus_in_tilt"]
-) / 2
-plt.plot(times, pd, label="swi-bon")
-plt.legend()
-plt.title("distractor decoding")
-fig.show()
+# Plot cue, response, target and distractor decoding, averaged over the color and tilt task
+for target in ["cue", "response", "target", "distractor"]:
+    fig = plt.figure()
+    for sequence, sequence_abbr in [("repeat", "rep"), ("switch", "swi")]:
+        for reward, reward_abbr in [("standard", "std"), ("bonus", "bon")]:
+            pd = query.mean(
+                query.select(target, sequence=sequence, reward=reward),
+                smoothing_length,
+                smoothing_mode,
+            )
+            plt.plot(times, pd, label=f"{sequence_abbr}-{reward_abbr}")
+    plt.legend()
+    plt.title(f"{target} decoding")
+    fig.show()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cluster-based permutation tests for decoding time courses and temporal
+generalization matrices.
+
+All permutations are drawn up front as one matrix: sign flips for one-sample
+(paired) t-tests, orders of the pooled observations for F-tests between
+conditions. The first row is the identity, i.e. the observed data. Statistics
+of a chunk of permutations are obtained with one matrix product. Clusters of
+supra-threshold samples are labelled without loops over samples: runs in 1-D by
+a cumulative sum over run starts, 4-connected components in 2-D by min-label
+propagation with pointer jumping. Cluster masses (sums of the statistic) are
+summed with np.bincount. The interface mirrors mne.stats.permutation_cluster_test
+with out_type="mask".
+"""
+
+# Imports
+import numpy as np
+
+
+def sign_flips(n_samples, n_permutations, seed=None):
+    """Random sign flips as (n_permutations, n_samples), first row all ones."""
+    rng = np.random.default_rng(seed)
+    signs = rng.choice([-1.0, 1.0], size=(n_permutations, n_samples))
+    signs[0] = 1
+    return signs
+
+
+def label_permutations(n_samples, n_permutations, seed=None):
+    """Random orders of n_samples as (n_permutations, n_samples), first row identity."""
+    rng = np.random.default_rng(seed)
+    orders = np.argsort(rng.random((n_permutations, n_samples)), axis=1)
+    orders[0] = np.arange(n_samples)
+    return orders
+
+
+def ttest_1samp(X, signs):
+    """One-sample t-values of sign-flipped data.
+
+    X is (n_samples, n_features), signs (n_permutations, n_samples). Returns
+    (n_permutations, n_features). Squares do not depend on the signs, so only
+    the sums are permuted.
+    """
+    n_samples = X.shape[0]
+    mean = (signs @ X) / n_samples
+    var = ((X**2).sum(axis=0) - n_samples * mean**2) / (n_samples - 1)
+    return mean / np.sqrt(np.maximum(var, np.finfo(float).tiny) / n_samples)
+
+
+def f_oneway(X, group_sizes, orders):
+    """One-way ANOVA F-values of permuted group assignments.
+
+    X is (n_samples, n_features) with the groups stacked in order of
+    group_sizes, orders (n_permutations, n_samples). Returns
+    (n_permutations, n_features). The total sum of squares does not depend on
+    the assignment, so only the group sums are permuted.
+    """
+
+    # Get dims
+    n_samples = X.shape[0]
+    n_groups = len(group_sizes)
+    n_permutations = orders.shape[0]
+
+    # Group membership of positions, assigned to samples by the orders
+    group_of_position = np.repeat(np.arange(n_groups), group_sizes)
+    group_of_sample = np.empty_like(orders)
+    np.put_along_axis(
+        group_of_sample,
+        orders,
+        np.broadcast_to(group_of_position, orders.shape),
+        axis=1,
+    )
+
+    # Between-group sum of squares from group sums
+    total = X.sum(axis=0)
+    ss_between = -(total**2) / n_samples
+    for group_idx, group_size in enumerate(group_sizes):
+        indicator = (group_of_sample == group_idx).astype(X.dtype)
+        ss_between = ss_between + (indicator @ X) ** 2 / group_size
+
+    # Within-group sum of squares
+    ss_total = (X**2).sum(axis=0) - total**2 / n_samples
+    ss_within = ss_total - ss_between
+
+    # F-values
+    df_between, df_within = n_groups - 1, n_samples - n_groups
+    return (ss_between / df_between) / (
+        np.maximum(ss_within, np.finfo(float).tiny) / df_within
+    ) + np.zeros((n_permutations, 1))
+
+
+def label_clusters_1d(mask):
+    """Label runs of True in each row of mask (batch, n_times).
+
+    Returns labels of the same shape, 0 outside clusters, unique over the batch.
+    """
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+    return np.where(mask, np.cumsum(starts.ravel()).reshape(mask.shape), 0)
+
+
+def label_clusters_2d(mask):
+    """Label 4-connected components of mask (batch, n_rows, n_cols).
+
+    Returns labels of the same shape, 0 outside clusters, unique over the batch.
+    Every sample starts with its own flat index as label, labels are replaced
+    by the minimum of their neighbours and then by the label of the sample they
+    point to, until nothing changes.
+    """
+
+    # Initial labels are flat indices + 1. Samples outside clusters get a label larger than all others
+    outside = mask.size + 1
+    labels = np.where(mask, np.arange(1, mask.size + 1).reshape(mask.shape), outside)
+
+    while True:
+
+        # Minimum over 4-neighbours
+        new = labels.copy()
+        np.minimum(new[:, 1:, :], labels[:, :-1, :], out=new[:, 1:, :])
+        np.minimum(new[:, :-1, :], labels[:, 1:, :], out=new[:, :-1, :])
+        np.minimum(new[:, :, 1:], labels[:, :, :-1], out=new[:, :, 1:])
+        np.minimum(new[:, :, :-1], labels[:, :, 1:], out=new[:, :, :-1])
+        new[~mask] = outside
+
+        # Pointer jumping: take over the label of the sample the label points to
+        flat = new.ravel()
+        inside = flat < outside
+        flat[inside] = flat[flat[inside] - 1]
+
+        if np.array_equal(new, labels):
+            break
+        labels = new
+
+    return np.where(mask, labels, 0)
+
+
+def label_clusters(mask):
+    """Label clusters of a batch of 1-D or 2-D masks."""
+    if mask.ndim == 2:
+        return label_clusters_1d(mask)
+    if mask.ndim == 3:
+        return label_clusters_2d(mask)
+    raise ValueError("masks have to be (batch, n_times) or (batch, n_times, n_times)")
+
+
+def cluster_masses(stat, mask):
+    """Masses of the clusters of a batch.
+
+    Returns the masses, the batch index of each cluster, and the cluster index
+    of every sample in mask (for building cluster masks).
+    """
+    labels = label_clusters(mask)
+    batch_idx = np.nonzero(mask)[0]
+    _, cluster_of_sample = np.unique(labels[mask], return_inverse=True)
+    masses = np.bincount(cluster_of_sample, weights=stat[mask])
+    cluster_batch = np.zeros(masses.shape, dtype=int)
+    cluster_batch[cluster_of_sample] = batch_idx
+    return masses, cluster_batch, cluster_of_sample
+
+
+def supra_threshold_masks(stat, threshold, tail):
+    """Masks of positive and/or negative supra-threshold samples."""
+    masks = []
+    if tail >= 0:
+        masks.append(stat > threshold)
+    if tail <= 0:
+        masks.append(stat < -threshold)
+    return masks
+
+
+def max_cluster_mass(stat, threshold, tail):
+    """Largest absolute cluster mass of each row of a batch of statistics."""
+    max_mass = np.zeros(stat.shape[0])
+    for mask in supra_threshold_masks(stat, threshold, tail):
+        masses, cluster_batch, _ = cluster_masses(stat, mask)
+        np.maximum.at(max_mass, cluster_batch, np.abs(masses))
+    return max_mass
+
+
+def cluster_test(statistic, n_permutations, shape, threshold, tail, chunk_size):
+    """Core of the tests. statistic(start, stop) returns statistics of
+    permutations start to stop as (stop - start, n_features)."""
+
+    # Null distribution of the maximum cluster mass, in chunks of permutations
+    H0 = []
+    for start in range(0, n_permutations, chunk_size):
+        stat = statistic(start, min(start + chunk_size, n_permutations))
+        stat = stat.reshape((-1,) + shape)
+        if start == 0:
+            # The observed statistic is the first row, the identity permutation
+            stat_obs = stat[:1]
+        H0.append(max_cluster_mass(stat, threshold, tail))
+    H0 = np.concatenate(H0)
+
+    # Observed clusters
+    clusters, masses_obs = [], []
+    for mask in supra_threshold_masks(stat_obs, threshold, tail):
+        masses, _, cluster_of_sample = cluster_masses(stat_obs, mask)
+        sample_idx = np.flatnonzero(mask)
+        for cluster_idx, mass in enumerate(masses):
+            cluster = np.zeros(np.prod(shape), dtype=bool)
+            cluster[sample_idx[cluster_of_sample == cluster_idx]] = True
+            clusters.append(cluster.reshape(shape))
+            masses_obs.append(mass)
+
+    # Cluster p-values. The observed data is part of the null distribution
+    cluster_p_values = np.array([(H0 >= np.abs(mass)).mean() for mass in masses_obs])
+
+    return stat_obs[0], clusters, cluster_p_values, H0
+
+
+def permutation_cluster_1samp_test(
+    X,
+    threshold,
+    n_permutations=1024,
+    tail=0,
+    seed=None,
+    signs=None,
+    chunk_size=256,
+):
+    """Cluster permutation test of a one-sample t-test by sign flips.
+
+    X is (n_subjects, n_times) or (n_subjects, n_times, n_times), e.g.
+    differences of paired conditions. signs can be given instead of drawn, see
+    sign_flips. Returns T_obs, clusters (boolean masks), cluster_p_values, H0.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    shape = X.shape[1:]
+    X = X.reshape((X.shape[0], -1))
+    if signs is None:
+        signs = sign_flips(X.shape[0], n_permutations, seed)
+    return cluster_test(
+        lambda start, stop: ttest_1samp(X, signs[start:stop]),
+        signs.shape[0],
+        shape,
+        threshold,
+        tail,
+        chunk_size,
+    )
+
+
+def permutation_cluster_test(
+    X_list,
+    threshold,
+    n_permutations=1024,
+    tail=0,
+    seed=None,
+    orders=None,
+    chunk_size=256,
+):
+    """Cluster permutation test of a one-way F-test by permuting conditions.
+
+    X_list holds the data of conditions as (n_observations, n_times) or
+    (n_observations, n_times, n_times), as in
+    mne.stats.permutation_cluster_test. orders can be given instead of drawn,
+    see label_permutations. Returns T_obs, clusters (boolean masks),
+    cluster_p_values, H0.
+    """
+    shape = np.shape(X_list[0])[1:]
+    group_sizes = [len(X) for X in X_list]
+    X = np.concatenate(
+        [np.asarray(X, dtype=np.float64).reshape((len(X), -1)) for X in X_list]
+    )
+    if orders is None:
+        orders = label_permutations(X.shape[0], n_permutations, seed)
+    return cluster_test(
+        lambda start, stop: f_oneway(X, group_sizes, orders[start:stop]),
+        orders.shape[0],
+        shape,
+        threshold,
+        tail,
+        chunk_size,
+    )
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dispatch of decoding work to workers via memory-mapped files.
+
+The feature tensor (time x trials x features) and trialinfo of a subject are
+written to .npy files once, named per subject. Workers open them memory-mapped
+and only receive the file names, a chunk of time points and the trial indices
+of a task group (see job_scheduler). Nothing large is pickled per job, so
+dispatch cost does not grow with the number of tasks and joblib does not need
+to dump arrays into its temp folder.
+"""
+
+# Imports
+import functools
+import os
+import numpy as np
+import decoding_scheduler
+import tf_cache
+
+
+def share_array(array, file_name):
+    """Make an array available to workers as a .npy file. Returns the file name.
+
+    Memory-mapped .npy arrays are shared as they are, other arrays are written
+    once. Files are moved into place complete, so workers never read a partly
+    written file.
+    """
+
+    # Already on disk
+    if isinstance(array, np.memmap) and str(array.filename).endswith(".npy"):
+        return str(array.filename)
+
+    # Write once
+    tf_cache.write_atomic(
+        file_name, lambda tmp: tf_cache.save_npy(tmp, np.asarray(array))
+    )
+
+    return file_name
+
+
+@functools.lru_cache(maxsize=4)
+def open_shared(file_name, mtime):
+    """Open a shared .npy file read-only.
+
+    Cached per worker process. The modification time is part of the cache key,
+    so rewritten files are reopened by reused workers.
+    """
+    return np.load(file_name, mmap_mode="r")
+
+
+def compact_task_group(task_group, plans=None):
+    """Task group with integer trial indices and without per-task masks.
+
+    Resampling plans of the tasks are attached as "plan", if given as a dict
+    keyed by task label.
+    """
+    plans = plans or {}
+    return {
+        "trial_idx": np.flatnonzero(task_group["trial_idx"]).astype(np.int32),
+        "tasks": [
+            {
+                "label": decoding_task["label"],
+                "y_col": decoding_task["y_col"],
+                "plan": plans.get(decoding_task["label"]),
+            }
+            for decoding_task in task_group["tasks"]
+        ],
+    }
+
+
+def decode_group_unit(
+    features_file,
+    trialinfo_file,
+    time_idx,
+    task_group,
+    classifier,
+    seed=None,
+    binsize=15,
+):
+    """Decode one task group at one time point from the shared files.
+
+    File names are passed as (file name, modification time).
+    """
+
+    # Open shared inputs
+    X_all = open_shared(*features_file)[time_idx]
+    trialinfo = open_shared(*trialinfo_file)
+
+    return decoding_scheduler.decode_group_timeslice(
+        X_all,
+        trialinfo,
+        task_group,
+        classifier,
+        binsize=binsize,
+        seed=seed,
+    )
+
+
+def decode_group_chunk(
+    unit, features_file, trialinfo_file, classifier, seed=None, binsize=15
+):
+    """Decode the task group of a job_scheduler unit at its chunk of time points.
+
+    Returns a dict mapping task labels to accuracies as (stop - start,).
+    """
+    accs = [
+        decode_group_unit(
+            features_file,
+            trialinfo_file,
+            time_idx,
+            unit["task_group"],
+            classifier,
+            seed,
+            binsize,
+        )
+        for time_idx in range(unit["start"], unit["stop"])
+    ]
+    return {label: np.array([acc[label] for acc in accs]) for label in accs[0]}
+
+
+def decode_group_generalization_chunk(
+    unit, features_file, trialinfo_file, classifier, seed=None, binsize=15, chunk_size=4
+):
+    """Decode the task group of a job_scheduler unit in temporal generalization,
+    with the unit's chunk of time points as train times.
+
+    chunk_size train times are fitted at once, see
+    decoding_engine.decode_generalization.
+
+    Returns a dict mapping task labels to accuracies as (stop - start, n_times).
+    """
+
+    # Open shared inputs
+    X_times = open_shared(*features_file)
+    trialinfo = open_shared(*trialinfo_file)
+
+    return decoding_scheduler.decode_group_generalization(
+        X_times,
+        trialinfo,
+        unit["task_group"],
+        np.arange(unit["start"], unit["stop"]),
+        classifier,
+        binsize=binsize,
+        seed=seed,
+        chunk_size=chunk_size,
+    )
+
+
+def share_inputs(features, trialinfo, path_shared, subject):
+    """Share features and trialinfo of a subject with workers.
+
+    features is a FeatureProvider or an array of shape time x trials x features.
+    Files are named per subject (features_<subject>.npy, as FeatureProvider
+    files of the decoding scripts, and trialinfo_<subject>.npy), so that runs of
+    different subjects sharing path_shared do not overwrite each other. Returns
+    both files as (file name, modification time).
+    """
+
+    # Share features and trialinfo once
+    features = getattr(features, "data", features)
+    features_file = share_array(
+        features, os.path.join(path_shared, f"features_{subject}.npy")
+    )
+    trialinfo_file = share_array(
+        trialinfo, os.path.join(path_shared, f"trialinfo_{subject}.npy")
+    )
+
+    # Identify files by name and modification time
+    return (
+        (features_file, os.stat(features_file).st_mtime_ns),
+        (trialinfo_file, os.stat(trialinfo_file).st_mtime_ns),
+    )
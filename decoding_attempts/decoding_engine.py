@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched leave-one-bin-out cross-validation for linear classifiers.
+
+Binned data is passed as an array of shape (n_iterations, 2, n_bins, n_features),
+i.e. the ERP-bins of class 0 and class 1 for every undersampling iteration. All
+folds of all iterations are fitted at once by a batched Newton solver. Folds are
+not materialized as training arrays. Instead, every fold is a row of sample
+weights on the one stacked array, with zero weight for the held-out bins.
+
+The LDA backend is closed-form. Class sums and moments are computed once on all
+bins and each fold's statistics are obtained by removing the held-out bin.
+
+For temporal generalization, the bins of all time points are passed as
+(n_iterations, n_times, 2, n_bins, n_features). The folds are fitted once per
+train time, in chunks of train times to bound memory, and the fitted weights
+are scored against all test times at once.
+"""
+
+# Imports
+import numpy as np
+
+
+def stack_bins(X_binned):
+    """Stack class bins to samples x features (a view) and create labels.
+
+    X_binned is (n_iterations, 2, n_bins, n_features). Returns X as
+    (n_iterations, 2 * n_bins, n_features) and y as (2 * n_bins,)
+    """
+
+    # Get dims
+    n_iterations, n_classes, n_bins, n_features = X_binned.shape
+
+    # Class blocks are contiguous, so this is a reshape without copy
+    X = X_binned.reshape((n_iterations, n_classes * n_bins, n_features))
+
+    # Labels follow the class blocks
+    y = np.repeat(np.arange(n_classes), n_bins).astype(X.dtype)
+
+    return X, y
+
+
+def leave_one_bin_out_weights(n_bins, dtype=np.float64):
+    """Sample weights for all leave-one-bin-out folds.
+
+    Returns (n_bins, 2 * n_bins). Row k is 0 for bin k of both classes, else 1.
+    """
+
+    # Keep all but the diagonal
+    keep = 1 - np.eye(n_bins, dtype=dtype)
+
+    # Same pattern for both class blocks
+    return np.concatenate((keep, keep), axis=1)
+
+
+def fit_linear_folds(X, y, weights, loss="log", C=1.0, max_iter=50, tol=None):
+    """Fit a regularized linear classifier for all folds of all iterations.
+
+    X is (n_iterations, n_samples, n_features), y is (n_samples,) coded 0/1 and
+    weights is (n_folds, n_samples). loss="log" reproduces
+    sklearn.linear_model.LogisticRegression (L2, unpenalized intercept) and
+    loss="squared_hinge" reproduces sklearn.svm.LinearSVC (L2, penalized
+    intercept). Returns coef as (n_iterations, n_folds, n_features) and
+    intercept as (n_iterations, n_folds).
+
+    Computations are done in the dtype of X. The default tolerance on the
+    Newton step is 1e-6, or what single precision can resolve for float32.
+    """
+
+    # Get dims
+    n_iterations, n_samples, n_features = X.shape
+    n_folds = weights.shape[0]
+    dtype = X.dtype
+
+    # Default tolerance within the precision of dtype
+    if tol is None:
+        tol = max(1e-6, 10 * np.sqrt(np.finfo(dtype).eps))
+
+    # Augment features with a column of ones for the intercept
+    Xa = np.concatenate((X, np.ones((n_iterations, n_samples, 1), dtype=dtype)), axis=2)
+
+    # Regularization on the diagonal of the Hessian. Scaled by 1 / C so that the
+    # loss term needs no scaling.
+    penalty = np.full((n_features + 1,), 1 / C, dtype=dtype)
+    if loss == "log":
+        penalty[-1] = 0
+    elif loss != "squared_hinge":
+        raise ValueError(f"unknown loss '{loss}'")
+
+    # Targets as +-1 for the hinge loss
+    t = 2 * y - 1
+
+    # Init parameters with zeros
+    beta = np.zeros((n_iterations, n_folds, n_features + 1), dtype=dtype)
+
+    # Newton iterations, all folds and iterations in one batch
+    for _ in range(max_iter):
+
+        # Decision values (n_iterations, n_folds, n_samples)
+        z = np.matmul(beta, Xa.transpose((0, 2, 1)))
+
+        # Residuals and curvature per sample
+        if loss == "log":
+            p = 1 / (1 + np.exp(-z))
+            residual = weights * (p - y)
+            curvature = weights * p * (1 - p)
+        else:
+            margin = 1 - t * z
+            active = weights * (margin > 0)
+            residual = -2 * active * margin * t
+            curvature = 2 * active
+
+        # Gradient (n_iterations, n_folds, n_features + 1)
+        gradient = np.matmul(residual, Xa) + penalty * beta
+
+        # Hessian (n_iterations, n_folds, n_features + 1, n_features + 1)
+        hessian = np.matmul(
+            Xa[:, None, :, :].transpose((0, 1, 3, 2)) * curvature[:, :, None, :],
+            Xa[:, None, :, :],
+        )
+        hessian += np.diag(penalty)
+
+        # Newton step
+        step = np.linalg.solve(hessian, gradient[..., None])[..., 0]
+        beta -= step
+
+        # Check convergence
+        if np.abs(step).max() < tol:
+            break
+
+    return beta[..., :-1], beta[..., -1]
+
+
+def fit_lda_folds(X_binned):
+    """Shrinkage-LDA for all leave-one-bin-out folds of all iterations.
+
+    Class means and the pooled covariance of each fold are obtained by
+    downdating the statistics of all bins by the held-out bin. The covariance
+    is shrunk towards a scaled identity with the Ledoit-Wolf intensity. Returns
+    coef as (n_iterations, n_folds, n_features) and intercept as
+    (n_iterations, n_folds) in the dtype of X_binned.
+
+    The downdated moments cancel strongly, so they are always computed in
+    double precision.
+    """
+
+    # Get dims
+    n_iterations, n_classes, n_bins, n_features = X_binned.shape
+    dtype = X_binned.dtype
+    X_binned = X_binned.astype(np.float64, copy=False)
+
+    # Squared norms of bins (n_iterations, 2, n_bins)
+    sq_norm = np.einsum("icbf,icbf->icb", X_binned, X_binned)
+
+    # Statistics of all bins per class: sums, outer products, third and fourth moments
+    s1 = X_binned.sum(axis=2)
+    s2 = np.matmul(X_binned.transpose((0, 1, 3, 2)), X_binned)
+    s3 = np.einsum("icb,icbf->icf", sq_norm, X_binned)
+    s4 = (sq_norm**2).sum(axis=2)
+
+    # Downdate by held-out bin. Dims are iterations x classes x folds (x features)
+    n = n_bins - 1
+    s1 = s1[:, :, None, :] - X_binned
+    s2 = s2[:, :, None, :, :] - X_binned[..., :, None] * X_binned[..., None, :]
+    s3 = s3[:, :, None, :] - sq_norm[..., None] * X_binned
+    s4 = s4[:, :, None] - sq_norm**2
+
+    # Class means of folds
+    means = s1 / n
+
+    # Pooled within-class covariance (iterations x folds x features x features)
+    scatter = s2 - n * means[..., :, None] * means[..., None, :]
+    n_samples = n_classes * n
+    cov = scatter.sum(axis=1) / n_samples
+
+    # Sum of fourth powers of the centered samples, expanded in the moments
+    m_sq = (means**2).sum(axis=-1)
+    m_s2_m = np.einsum("icbf,icbfg,icbg->icb", means, s2, means)
+    s4_centered = (
+        s4
+        + 4 * m_s2_m
+        + n * m_sq**2
+        - 4 * (s3 * means).sum(axis=-1)
+        + 2 * m_sq * np.trace(s2, axis1=-2, axis2=-1)
+        - 4 * m_sq * (s1 * means).sum(axis=-1)
+    ).sum(axis=1)
+
+    # Ledoit-Wolf shrinkage intensity (as in sklearn.covariance.ledoit_wolf_shrinkage)
+    mu = np.trace(cov, axis1=-2, axis2=-1) / n_features
+    cov_sq = (cov**2).sum(axis=(-2, -1))
+    beta = (s4_centered / n_samples - cov_sq) / n_samples / n_features
+    delta = (cov_sq - n_features * mu**2) / n_features
+    beta = np.minimum(beta, delta)
+    shrinkage = np.divide(beta, delta, out=np.zeros_like(beta), where=delta > 0)
+
+    # Shrink covariance
+    cov *= (1 - shrinkage)[..., None, None]
+    cov += (shrinkage * mu)[..., None, None] * np.eye(n_features, dtype=cov.dtype)
+
+    # Discriminant for equal priors
+    coef = np.linalg.solve(cov, (means[:, 1] - means[:, 0])[..., None])[..., 0]
+    intercept = -0.5 * (coef * (means[:, 0] + means[:, 1])).sum(axis=-1)
+
+    return coef.astype(dtype, copy=False), intercept.astype(dtype, copy=False)
+
+
+def score_folds(X_binned, coef, intercept):
+    """Accuracy on the held-out bins of every fold.
+
+    X_binned is (n_iterations, 2, n_bins, n_features), coef and intercept as
+    returned by fit_folds. Fold k is tested on bin k of both classes.
+    Returns accuracies as (n_iterations, n_folds).
+    """
+
+    # Decision values of held-out bins (n_iterations, 2, n_folds)
+    z = np.einsum("icbf,ibf->icb", X_binned, coef) + intercept[:, None, :]
+
+    # Class 0 is correct if negative, class 1 if positive
+    correct = np.stack((z[:, 0, :] <= 0, z[:, 1, :] > 0))
+
+    return correct.mean(axis=0)
+
+
+def fit_folds(X_binned, classifier="logreg", C=1.0):
+    """Fit all leave-one-bin-out folds with the chosen classifier.
+
+    classifier is "logreg", "svm" (linear, squared hinge) or "lda" (shrinkage).
+    Returns coef as (n_iterations, n_folds, n_features) and intercept as
+    (n_iterations, n_folds).
+    """
+
+    # Closed-form backend
+    if classifier == "lda":
+        return fit_lda_folds(X_binned)
+
+    # Iterative backends
+    losses = {"logreg": "log", "svm": "squared_hinge"}
+    if classifier not in losses:
+        raise ValueError(f"unknown classifier '{classifier}'")
+
+    # Stack data and create fold weights
+    X, y = stack_bins(X_binned)
+    weights = leave_one_bin_out_weights(X_binned.shape[2], dtype=X.dtype)
+
+    return fit_linear_folds(X, y, weights, loss=losses[classifier], C=C)
+
+
+def decode_binned(X_binned, classifier="logreg", C=1.0):
+    """Leave-one-bin-out accuracy for all iterations in one batched solve.
+
+    X_binned is (n_iterations, 2, n_bins, n_features). Returns accuracies as
+    (n_iterations, n_bins).
+    """
+
+    # Fit all folds
+    coef, intercept = fit_folds(X_binned, classifier=classifier, C=C)
+
+    # Test on held-out bins
+    return score_folds(X_binned, coef, intercept)
+
+
+def score_generalization(X_binned, coef, intercept):
+    """Accuracy of every train time on every test time.
+
+    X_binned is (n_iterations, n_times, 2, n_bins, n_features), coef is
+    (n_iterations, n_train, n_folds, n_features) and intercept is
+    (n_iterations, n_train, n_folds), fitted per train time. Fold k of every
+    train time is tested on bin k of every test time. Returns accuracies as
+    (n_train, n_times) with train time in rows, averaged over iterations and
+    folds.
+    """
+
+    # Get dims
+    n_iterations, n_times, n_classes, n_bins, n_features = X_binned.shape
+    n_train = coef.shape[1]
+
+    # Count correct predictions
+    n_correct = np.zeros((n_train, n_times))
+
+    # Loop iterations to keep decision values small
+    for iteration in range(n_iterations):
+
+        # Test bins as folds x features x (test times * classes)
+        X_test = X_binned[iteration].transpose((2, 3, 0, 1))
+        X_test = X_test.reshape((n_bins, n_features, n_times * n_classes))
+
+        # Weights as folds x train times x features
+        W = coef[iteration].transpose((1, 0, 2))
+
+        # Decision values as folds x train times x test times x classes
+        z = np.matmul(W, X_test).reshape((n_bins, n_train, n_times, n_classes))
+        z += intercept[iteration].T[:, :, None, None]
+
+        # Class 0 is correct if negative, class 1 if positive
+        n_correct += (z[..., 0] <= 0).sum(axis=0)
+        n_correct += (z[..., 1] > 0).sum(axis=0)
+
+    return n_correct / (n_iterations * n_bins * n_classes)
+
+
+def decode_generalization(
+    X_binned, classifier="logreg", C=1.0, train_times=None, chunk_size=4
+):
+    """Temporal generalization matrix with one fit per fold and train time.
+
+    X_binned is (n_iterations, n_times, 2, n_bins, n_features). train_times
+    are the indices of the train times to fit (default all). They are fitted
+    chunk_size at a time, so the batched solver holds the Hessians of
+    n_iterations * chunk_size * n_bins folds at most. Returns accuracies as
+    (len(train_times), n_times) with train time in rows.
+    """
+
+    # Get dims
+    n_iterations, n_times, n_classes, n_bins, n_features = X_binned.shape
+    if train_times is None:
+        train_times = np.arange(n_times)
+    train_times = np.asarray(train_times)
+
+    # Fit chunks of train times as one batch of iterations each, score on all test times
+    acc = np.zeros((len(train_times), n_times))
+    for start in range(0, len(train_times), chunk_size):
+        chunk = train_times[start : start + chunk_size]
+        coef, intercept = fit_folds(
+            X_binned[:, chunk].reshape(
+                (n_iterations * len(chunk), n_classes, n_bins, n_features)
+            ),
+            classifier=classifier,
+            C=C,
+        )
+        acc[start : start + len(chunk)] = score_generalization(
+            X_binned,
+            coef.reshape((n_iterations, len(chunk), n_bins, n_features)),
+            intercept.reshape((n_iterations, len(chunk), n_bins)),
+        )
+
+    return acc
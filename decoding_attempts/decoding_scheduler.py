@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scheduling of decoding tasks that share trial selections.
+
+Many decoding tasks select identical trials and only differ in the label column.
+Tasks are grouped by their trial mask (see task_specs.CompiledTasks.task_groups),
+so that the rows of a time slice are selected and scaled once per group. The
+label columns of a group are then undersampled and binned on the same prepared
+data and fitted in one batch. In temporal generalization, a group is binned at
+all time points and fitted at a chunk of train times, so that job_scheduler
+units bound memory and can be resumed like time courses.
+"""
+
+# Imports
+import numpy as np
+import sklearn.preprocessing
+import decoding_engine
+import resampling
+import rng_streams
+
+
+def decode_group_timeslice(
+    X_all,
+    trialinfo,
+    task_group,
+    classifier="logreg",
+    n_iterations=50,
+    binsize=15,
+    seed=None,
+):
+    """Decode all tasks of a group for one time slice.
+
+    Rows are selected and scaled once for the group. Tasks may carry a
+    resampling.ResamplingPlan as "plan", which is then applied instead of
+    drawing new trial orders (n_iterations is then taken from the plan). New
+    trial orders are drawn from the stream (seed, task label), see
+    rng_streams, so that all time slices of a task use the same trials.
+    Returns a dict mapping task labels to the average leave-one-bin-out
+    accuracy.
+    """
+
+    # Select and scale X data once for all tasks of the group
+    X = sklearn.preprocessing.StandardScaler().fit_transform(
+        X_all[task_group["trial_idx"], :]
+    )
+
+    # Binned data of tasks, collected by number of bins so they can share a batch
+    batches = {}
+
+    # Loop tasks
+    for decoding_task in task_group["tasks"]:
+
+        # Undersampled and shuffled trial order of all iterations, shared across time slices
+        plan = decoding_task.get("plan")
+        if plan is None:
+            plan = resampling.ResamplingPlan(
+                trialinfo[decoding_task["y_col"]][task_group["trial_idx"]],
+                n_iterations=n_iterations,
+                seed=rng_streams.stream(seed, decoding_task["label"]),
+            )
+
+        # Binning. Create ERPs of all iterations at once
+        X_binned = plan.bin(X, binsize)
+        n_bins_per_class = X_binned.shape[2]
+
+        # Collect by number of bins
+        batches.setdefault(n_bins_per_class, []).append(
+            (decoding_task["label"], X_binned)
+        )
+
+    # Fit each batch of tasks at once
+    average_acc = {}
+    for batch in batches.values():
+
+        # Tasks are stacked along the iterations
+        acc = decoding_engine.decode_binned(
+            np.concatenate([X_binned for _, X_binned in batch]), classifier=classifier
+        )
+
+        # Average per task
+        start = 0
+        for label, X_binned in batch:
+            average_acc[label] = acc[start : start + X_binned.shape[0]].mean()
+            start += X_binned.shape[0]
+
+    return average_acc
+
+
+def decode_group_generalization(
+    X_times,
+    trialinfo,
+    task_group,
+    train_times,
+    classifier="logreg",
+    n_iterations=50,
+    binsize=15,
+    seed=None,
+    chunk_size=4,
+):
+    """Decode all tasks of a group in temporal generalization, for some train times.
+
+    X_times is time x trials x features. Rows are selected and scaled once per
+    time slice for the group. Tasks are binned with their resampling plan at
+    all time points, or with trial orders drawn from the stream (seed, task
+    label), so that the same trials are used at all time points. Only
+    train_times are fitted, chunk_size at a time (see
+    decoding_engine.decode_generalization). Returns a dict mapping task labels
+    to accuracies as (len(train_times), n_times).
+    """
+
+    # Select and scale X data once per time slice for all tasks of the group
+    X_scaled = [
+        sklearn.preprocessing.StandardScaler().fit_transform(
+            X_all[task_group["trial_idx"], :]
+        )
+        for X_all in X_times
+    ]
+
+    # Loop tasks
+    accs = {}
+    for decoding_task in task_group["tasks"]:
+
+        # Undersampled and shuffled trial order of all iterations, shared across time slices
+        plan = decoding_task.get("plan")
+        if plan is None:
+            plan = resampling.ResamplingPlan(
+                trialinfo[decoding_task["y_col"]][task_group["trial_idx"]],
+                n_iterations=n_iterations,
+                seed=rng_streams.stream(seed, decoding_task["label"]),
+            )
+
+        # Bins are iterations x times x classes x bins x features
+        X_binned = np.stack([plan.bin(X, binsize) for X in X_scaled], axis=1)
+
+        # Fit at train times, test at all times
+        accs[decoding_task["label"]] = decoding_engine.decode_generalization(
+            X_binned,
+            classifier=classifier,
+            train_times=train_times,
+            chunk_size=chunk_size,
+        )
+
+    return accs
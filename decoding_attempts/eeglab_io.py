@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Loading of cleaned EEGLAB datasets.
+
+A .set file is opened once. Header fields (srate, times, trialinfo, dims) are
+read together on first access without parsing the data. Data is not kept on
+the opened dataset: every access memory-maps the .fdt file or, for data stored
+inline in the .set file, reads it. trial_data converts inline data once to a
+.npy file, so that chunks of trials can be read from disk in either case. The
+converted file is a temporary copy, removed by its user with
+remove_trial_data.
+Channel labels are read once per directory.
+"""
+
+# Imports
+import functools
+import os
+import numpy as np
+import mne
+import scipy.io
+import tf_cache
+
+# Fields of the .set file read as header
+header_fields = ["srate", "nbchan", "pnts", "trials", "xmin", "times", "trialinfo"]
+
+
+@functools.lru_cache(maxsize=None)
+def channel_labels(path):
+    """Channel labels from channel_labels.mat in path, renamed to MNE's montage."""
+
+    # Read channel labels as list
+    channel_label_list = scipy.io.loadmat(os.path.join(path, "channel_labels.mat"))[
+        "channel_labels"
+    ][0].split(" ")[1:]
+
+    # Rename channels to match standard montage info of MNE
+    for x in range(len(channel_label_list)):
+        if channel_label_list[x] == "O9":
+            channel_label_list[x] = "OI1"
+        if channel_label_list[x] == "O10":
+            channel_label_list[x] = "OI2"
+
+    return tuple(channel_label_list)
+
+
+class EEGLABDataset:
+    """Lazily loaded EEGLAB dataset (.set with inline data or .set/.fdt pair)."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    @functools.cached_property
+    def header(self):
+        """All header fields, read in one pass."""
+        return scipy.io.loadmat(self.file_name, variable_names=header_fields)
+
+    @property
+    def srate(self):
+        return float(np.squeeze(self.header["srate"]))
+
+    @property
+    def tmin(self):
+        """Epoch start in s."""
+        return float(np.squeeze(self.header["xmin"]))
+
+    @property
+    def times(self):
+        """Epoch times in ms, as stored by EEGLAB."""
+        return np.squeeze(self.header["times"])
+
+    @property
+    def trialinfo(self):
+        return self.header["trialinfo"]
+
+    @property
+    def data(self):
+        """Epoch data as trials x channels x times (a transposed view).
+
+        Memory-mapped for .fdt files, read into memory for inline data. Not
+        cached, so the data is freed with the returned array.
+        """
+
+        # Data is either inline or the name of the .fdt file
+        data = scipy.io.loadmat(self.file_name, variable_names=["data"])["data"]
+
+        # Memory-map float32 .fdt payload. EEGLAB writes channels x times x trials column-major
+        if data.dtype.kind in "US":
+            shape = tuple(
+                int(np.squeeze(self.header[x])) for x in ("nbchan", "pnts", "trials")
+            )
+            data = np.memmap(
+                os.path.join(os.path.dirname(self.file_name), str(np.squeeze(data))),
+                dtype="<f4",
+                mode="r",
+                shape=shape,
+                order="F",
+            )
+
+        return data.transpose((2, 0, 1))
+
+    @property
+    def channel_labels(self):
+        return list(channel_labels(os.path.dirname(os.path.abspath(self.file_name))))
+
+    @functools.cached_property
+    def info(self):
+        """MNE info of all channels as EEG with standard montage, without reading data."""
+
+        # Create info struct
+        eeg_info = mne.create_info(self.channel_labels, self.srate, ch_types="eeg")
+
+        # Set montage
+        montage = mne.channels.make_standard_montage("standard_1005")
+        eeg_info.set_montage(montage)
+
+        return eeg_info
+
+    @property
+    def epoch_times(self):
+        """Epoch times in s, as in mne.EpochsArray (start rounded to a sample)."""
+        start = int(round(self.tmin * self.srate))
+        return (
+            np.arange(start, start + int(np.squeeze(self.header["pnts"]))) / self.srate
+        )
+
+
+@functools.lru_cache(maxsize=1)
+def open_dataset(file_name):
+    """Open a dataset. The last opened dataset is reused, so that it is read once
+    even if several steps of a script load from it."""
+    return EEGLABDataset(file_name)
+
+
+def converted_file(dataset, path_cache):
+    """File name of the inline data of a dataset converted to .npy in path_cache."""
+    return os.path.join(
+        path_cache, f"{tf_cache.dataset_hash(dataset, path_cache)}_data.npy"
+    )
+
+
+def trial_data(dataset, path_cache=None):
+    """Epoch data as trials x channels x times, readable in chunks of trials.
+
+    Data of .fdt files is memory-mapped. Inline data of .set files is read
+    once, written to path_cache as .npy (see converted_file) and memory-mapped
+    from there. Reading it once needs memory for all trials, and the copy
+    needs as much disk space as the data until it is removed with
+    remove_trial_data. With path_cache None, inline data is returned in
+    memory.
+    """
+
+    # Memory-mapped .fdt data
+    eeg_dataset = open_dataset(dataset)
+    data = eeg_dataset.data
+    if isinstance(data, np.memmap) or path_cache is None:
+        return data
+
+    # Convert inline data once, trials in the slowest dimension
+    os.makedirs(path_cache, exist_ok=True)
+    data_file = converted_file(dataset, path_cache)
+
+    def write(tmp_file):
+        out = np.lib.format.open_memmap(
+            tmp_file, mode="w+", dtype=data.dtype, shape=data.shape
+        )
+        for start in range(0, data.shape[0], 64):
+            out[start : start + 64] = data[start : start + 64]
+        out.flush()
+
+    if not os.path.isfile(data_file):
+        tf_cache.write_atomic(data_file, write)
+    del data
+
+    return np.load(data_file, mmap_mode="r")
+
+
+def remove_trial_data(dataset, path_cache):
+    """Remove inline data converted by trial_data, if any."""
+    try:
+        os.remove(converted_file(dataset, path_cache))
+    except FileNotFoundError:
+        pass
+
+
+def load_epochs(dataset):
+    """Load a cleaned dataset as mne.EpochsArray with standard montage."""
+
+    # Open dataset
+    eeg_dataset = open_dataset(dataset)
+
+    # Create epoch struct with EEG channels and standard montage
+    eeg_epochs = mne.EpochsArray(
+        eeg_dataset.data, eeg_dataset.info.copy(), tmin=eeg_dataset.tmin
+    )
+
+    return eeg_epochs
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Executors for decoding work units.
+
+An executor runs function(*args) for a list of argument tuples and returns the
+results in order. LocalExecutor runs them with joblib on this machine.
+FileQueueExecutor distributes them over machines through a directory on a
+shared file system: every call is written as a job file to pending/, workers
+claim jobs by renaming them to claimed/ (an atomic operation, so every job is
+run once), and write results to done/ (or the error to failed/).
+LocalQueueExecutor runs the same queue with worker processes on this machine.
+
+Workers on other machines are started with
+
+    python executors.py <path_queue>
+
+from this directory, so that the functions of the jobs can be imported. While
+running a job, a worker touches its file in claimed/ every heartbeat_interval
+seconds. The driver moves claimed jobs whose file has not changed for
+stale_after seconds (measured on the driver's clock) back to pending/, so jobs
+of crashed workers are run again by the others. The names of these jobs are
+kept in the executor's requeued list. With a timeout, the driver raises
+TimeoutError if no job finishes for that long, e.g. because no worker is
+running or a job crashes every worker that runs it. LocalQueueExecutor
+replaces worker processes that die (e.g. killed for lack of memory), and their
+jobs are requeued the same way.
+"""
+
+# Imports
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+import joblib
+import tf_cache
+
+
+class LocalExecutor:
+    """Run calls with joblib on this machine."""
+
+    def __init__(self, n_jobs=-2):
+        self.n_jobs = n_jobs
+
+    def map(self, function, arg_tuples):
+        return joblib.Parallel(n_jobs=self.n_jobs, max_nbytes=None)(
+            joblib.delayed(function)(*args) for args in arg_tuples
+        )
+
+
+class FileQueueExecutor:
+    """Run calls through a job queue directory served by workers (see work)."""
+
+    def __init__(self, path_queue, poll_interval=1.0, stale_after=120.0, timeout=None):
+        self.path_queue = path_queue
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.timeout = timeout
+        self.requeued = []
+        for state in ("pending", "claimed", "done", "failed"):
+            os.makedirs(os.path.join(path_queue, state), exist_ok=True)
+
+    def submit(self, function, arg_tuples):
+        """Write jobs to the queue. Returns their names."""
+        batch = uuid.uuid4().hex[:12]
+        names = []
+        for job_nr, args in enumerate(arg_tuples):
+            name = f"{batch}_{job_nr:06d}.joblib"
+            tf_cache.write_atomic(
+                os.path.join(self.path_queue, "pending", name),
+                lambda tmp: joblib.dump((function, args), tmp),
+            )
+            names.append(name)
+        return names
+
+    def check_workers(self, missing):
+        """Called while waiting for the jobs missing. Workers on other machines
+        are not known here, so nothing is checked."""
+
+    def requeue_stale(self, name, heartbeats):
+        """Move a claimed job back to pending/ if its heartbeat stopped.
+
+        heartbeats maps job names to (claimed file mtime, driver time when it was
+        first seen). Returns True if the job was moved.
+        """
+        claimed_file = os.path.join(self.path_queue, "claimed", name)
+        try:
+            mtime = os.stat(claimed_file).st_mtime
+        except FileNotFoundError:
+            heartbeats.pop(name, None)
+            return False
+        now = time.monotonic()
+        if name not in heartbeats or heartbeats[name][0] != mtime:
+            heartbeats[name] = (mtime, now)
+            return False
+        if now - heartbeats[name][1] < self.stale_after:
+            return False
+        try:
+            os.rename(claimed_file, os.path.join(self.path_queue, "pending", name))
+        except FileNotFoundError:
+            # Finished in the meantime
+            return False
+        del heartbeats[name]
+        return True
+
+    def collect(self, names):
+        """Wait for jobs to finish and return their results in order.
+
+        Names of jobs moved back to pending/ while waiting are kept in requeued.
+        """
+        self.requeued = []
+        results = {}
+        heartbeats = {}
+        last_progress = time.monotonic()
+        while len(results) < len(names):
+            n_results = len(results)
+            for name in names:
+                if name in results:
+                    continue
+
+                # Raise errors of failed jobs
+                failed_file = os.path.join(self.path_queue, "failed", name)
+                if os.path.isfile(failed_file):
+                    raise RuntimeError(
+                        f"job {name} failed:\n{joblib.load(failed_file)}"
+                    )
+
+                # Collect results of finished jobs
+                done_file = os.path.join(self.path_queue, "done", name)
+                if os.path.isfile(done_file):
+                    results[name] = joblib.load(done_file)
+                    os.remove(done_file)
+                    continue
+
+                # Rerun jobs of crashed workers
+                if self.requeue_stale(name, heartbeats):
+                    self.requeued.append(name)
+
+            # Stop waiting if nothing finishes or workers died
+            if len(results) > n_results:
+                last_progress = time.monotonic()
+            if len(results) < len(names):
+                if (
+                    self.timeout is not None
+                    and time.monotonic() - last_progress > self.timeout
+                ):
+                    raise TimeoutError(
+                        f"no job of {self.path_queue} finished for {self.timeout} s, "
+                        f"{len(names) - len(results)} jobs left"
+                    )
+                self.check_workers([name for name in names if name not in results])
+                time.sleep(self.poll_interval)
+
+        # Remove copies of jobs that were moved back to pending but finished anyway
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path_queue, "pending", name))
+            except FileNotFoundError:
+                pass
+
+        return [results[name] for name in names]
+
+    def map(self, function, arg_tuples):
+        return self.collect(self.submit(function, arg_tuples))
+
+
+class LocalQueueExecutor(FileQueueExecutor):
+    """File queue served by worker processes on this machine.
+
+    Behaves like FileQueueExecutor with workers on other machines, e.g. to
+    test a setup on one machine. Worker processes that die are replaced, and
+    their jobs are moved back to pending/ after stale_after seconds.
+    """
+
+    def __init__(
+        self,
+        path_queue,
+        n_workers=2,
+        poll_interval=0.1,
+        stale_after=120.0,
+        timeout=None,
+    ):
+        super().__init__(path_queue, poll_interval, stale_after, timeout)
+        self.n_workers = n_workers
+        self.workers = []
+
+    def start_worker(self):
+        """Start a worker process that stops when no job is pending."""
+        worker = multiprocessing.Process(
+            target=work, args=(self.path_queue, self.poll_interval, True)
+        )
+        worker.start()
+        return worker
+
+    def check_workers(self, missing):
+        """Replace worker processes that died, and restart exited ones while jobs
+        are pending (e.g. moved back from a dead worker)."""
+        pending = any(
+            os.path.isfile(os.path.join(self.path_queue, "pending", name))
+            for name in missing
+        )
+        for worker_idx, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            if worker.exitcode != 0 or pending:
+                worker.join()
+                self.workers[worker_idx] = self.start_worker()
+
+    def map(self, function, arg_tuples):
+        names = self.submit(function, arg_tuples)
+        self.workers = [self.start_worker() for _ in range(self.n_workers)]
+        try:
+            return self.collect(names)
+        finally:
+            for worker in self.workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            self.workers = []
+
+
+def claim(path_queue):
+    """Claim the next pending job. Returns its name, or None if none is left."""
+    for name in sorted(os.listdir(os.path.join(path_queue, "pending"))):
+        if not name.endswith(".joblib"):
+            continue
+        claimed_file = os.path.join(path_queue, "claimed", name)
+        try:
+            os.rename(os.path.join(path_queue, "pending", name), claimed_file)
+            # First heartbeat
+            os.utime(claimed_file)
+        except FileNotFoundError:
+            # Claimed by another worker
+            continue
+        return name
+    return None
+
+
+def heartbeat(file_name, interval, stop):
+    """Touch file_name every interval seconds until stop is set or it is gone."""
+    while not stop.wait(interval):
+        try:
+            os.utime(file_name)
+        except FileNotFoundError:
+            return
+
+
+def run_job(path_queue, name, heartbeat_interval=10.0):
+    """Run a claimed job and move it to done/ (result) or failed/ (traceback)."""
+    claimed_file = os.path.join(path_queue, "claimed", name)
+    stop = threading.Event()
+    threading.Thread(
+        target=heartbeat, args=(claimed_file, heartbeat_interval, stop), daemon=True
+    ).start()
+    try:
+        try:
+            function, args = joblib.load(claimed_file)
+        except FileNotFoundError:
+            # Moved back to pending by the driver before it was loaded
+            return
+        try:
+            result = function(*args)
+            state = "done"
+        except Exception:
+            result = f"{socket.gethostname()}:{os.getpid()}\n{traceback.format_exc()}"
+            state = "failed"
+        tf_cache.write_atomic(
+            os.path.join(path_queue, state, name),
+            lambda tmp: joblib.dump(result, tmp),
+        )
+    finally:
+        stop.set()
+    try:
+        os.remove(claimed_file)
+    except FileNotFoundError:
+        # Moved back to pending by the driver, the result is already there
+        pass
+
+
+def work(path_queue, poll_interval=1.0, stop_when_empty=False, heartbeat_interval=10.0):
+    """Worker loop: claim and run jobs of a queue.
+
+    Runs until interrupted, or until no job is pending if stop_when_empty.
+    """
+    while True:
+        name = claim(path_queue)
+        if name is not None:
+            run_job(path_queue, name, heartbeat_interval)
+        elif stop_when_empty:
+            return
+        else:
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    work(sys.argv[1])
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time-slice features for decoding without one array per time point.
+
+The temporally smoothed features of all time points are computed once from a
+trial x channel x band x time tensor with a cumulative sum over time. They are
+stored as time x trial x (channel * band), so every time slice is a contiguous
+read-only view. The store can be a memory-mapped .npy file, in which case it
+is not held in RAM and workers read it directly from disk. A subset of trials
+(e.g. from trial_filter) is read chunk by chunk from tf_data, without copying
+tf_data first.
+"""
+
+# Imports
+import os
+import numpy as np
+
+
+class FeatureProvider:
+    """Read-only time-slice views of temporally smoothed features.
+
+    Indexing returns the trial x feature array of a time point. Features are
+    ordered channel-major, i.e. as in data.reshape((n_trials, n_channels * n_bands)).
+    Features are stored in dtype, by default the dtype of tf_data. Window sums
+    are always accumulated in double precision. If trial_idx is given, only
+    these trials of tf_data are used, in this order.
+    """
+
+    def __init__(
+        self,
+        tf_data,
+        times,
+        temporal_smoothing=1,
+        memmap_file=None,
+        chunk_size=64,
+        dtype=None,
+        trial_idx=None,
+    ):
+
+        # Get dims
+        n_trials, n_channels, n_bands, n_times = tf_data.shape
+        if trial_idx is not None:
+            n_trials = len(trial_idx)
+        n_out = n_times - temporal_smoothing + 1
+        dtype = tf_data.dtype if dtype is None else np.dtype(dtype)
+
+        # Allocate output as time x trials x features, in memory or on disk
+        shape = (n_out, n_trials, n_channels * n_bands)
+        if memmap_file is None:
+            data = np.empty(shape, dtype=dtype)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(memmap_file)), exist_ok=True)
+            data = np.lib.format.open_memmap(
+                memmap_file, mode="w+", dtype=dtype, shape=shape
+            )
+
+        # Sliding mean over time in chunks of trials to keep temporaries small
+        for start in range(0, n_trials, chunk_size):
+            stop = min(start + chunk_size, n_trials)
+
+            # Cumulative sum with a leading zero
+            csum = np.zeros(
+                (stop - start, n_channels, n_bands, n_times + 1), dtype=np.float64
+            )
+            rows = slice(start, stop) if trial_idx is None else trial_idx[start:stop]
+            np.cumsum(tf_data[rows], axis=3, out=csum[..., 1:])
+
+            # Window means as trials x channels x bands x time
+            window = (
+                csum[..., temporal_smoothing:] - csum[..., :n_out]
+            ) / temporal_smoothing
+
+            # Store as time x trials x features
+            data[:, start:stop, :] = window.transpose((3, 0, 1, 2)).reshape(
+                (n_out, stop - start, n_channels * n_bands)
+            )
+
+        # Reopen from disk read-only
+        if memmap_file is not None:
+            data.flush()
+            del data
+            data = np.load(memmap_file, mmap_mode="r")
+        else:
+            data.flags.writeable = False
+
+        # Keep data and dims
+        self.data = data
+        self.times = np.asarray(times)[:n_out]
+        self.n_channels = n_channels
+        self.n_bands = n_bands
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, time_idx):
+        return self.data[time_idx]
+
+    def __iter__(self):
+        for time_idx in range(len(self)):
+            yield self.data[time_idx]
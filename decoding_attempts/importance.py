@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Feature importances of decoding, aggregated online.
+
+ImportanceAccumulator keeps the running mean and variance (Welford's algorithm)
+of the importances of all folds of a time slice, so no per-fold lists are
+kept. Features are ordered channel-major, as in feature_provider, and results
+come back as channel x band arrays. stack combines the accumulators of all
+time slices into time x channel x band arrays of mean and variance.
+
+permutation_importances measures the drop in accuracy on held-out bins when
+the values of a feature are permuted across them. All permuted copies of the
+test data are predicted in one batch.
+"""
+
+# Imports
+import numpy as np
+
+
+class ImportanceAccumulator:
+    """Running mean and variance of feature importances of n_channels x n_bands features."""
+
+    def __init__(self, n_channels, n_bands):
+        self.shape = (n_channels, n_bands)
+        self.n = 0
+        self._mean = np.zeros(n_channels * n_bands)
+        self._m2 = np.zeros(n_channels * n_bands)
+
+    def add(self, importances):
+        """Add the importances of one fold, as features or channel x band."""
+        importances = np.asarray(importances, dtype=np.float64).ravel()
+        self.n += 1
+        delta = importances - self._mean
+        self._mean += delta / self.n
+        self._m2 += delta * (importances - self._mean)
+
+    @property
+    def mean(self):
+        """Mean importances as channel x band."""
+        return self._mean.reshape(self.shape)
+
+    @property
+    def variance(self):
+        """Sample variance of importances as channel x band, NaN for less than 2 folds."""
+        if self.n < 2:
+            return np.full(self.shape, np.nan)
+        return (self._m2 / (self.n - 1)).reshape(self.shape)
+
+
+def stack(accumulators):
+    """Mean and variance of accumulators (one per time slice) as time x channel x band."""
+    return (
+        np.stack([accumulator.mean for accumulator in accumulators]),
+        np.stack([accumulator.variance for accumulator in accumulators]),
+    )
+
+
+def permutation_importances(clf, X_test, y_test, n_repeats=5, random_state=None):
+    """Drop in accuracy of a fitted classifier when permuting single features.
+
+    Each feature is permuted across the test samples n_repeats times. The
+    permuted copies (n_repeats x n_features x n_test samples) are predicted in
+    one call. Returns the mean drop in accuracy per feature.
+    """
+
+    # Get dims
+    n_test, n_features = X_test.shape
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    # Random orders of test samples per repeat and feature
+    orders = np.argsort(
+        random_state.random_sample((n_repeats, n_features, n_test)), axis=2
+    )
+
+    # Copies of the test data with one feature permuted each, as repeat x feature x sample x feature
+    X_permuted = np.repeat(
+        np.broadcast_to(X_test, (n_features, n_test, n_features))[None],
+        n_repeats,
+        axis=0,
+    )
+    feature_idx = np.arange(n_features)
+    X_permuted[:, feature_idx, :, feature_idx] = X_test[
+        orders, feature_idx[None, :, None]
+    ].transpose((1, 0, 2))
+
+    # Accuracy of all permuted copies from one prediction
+    correct = clf.predict(X_permuted.reshape((-1, n_features))).reshape(
+        (n_repeats, n_features, n_test)
+    ) == np.asarray(y_test)
+    baseline = np.mean(clf.predict(X_test) == np.asarray(y_test))
+
+    return baseline - correct.mean(axis=2).mean(axis=0)
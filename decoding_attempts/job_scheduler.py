@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resumable scheduling of decoding work.
+
+Work is split into units of (subject, task group, chunk of time points). Every
+finished unit writes a completion record (its results) atomically to the jobs
+directory, so an interrupted run resumes with the units that have no record.
+Units run with a configurable number of concurrent workers. Subjects are
+prepared (loading, time-frequency analysis, features) in a background thread
+while the previous subject decodes.
+
+Records are identified by subject, task labels, time points and a hash of the
+analysis setup (features, trial selection, resampling plans, ...) passed to
+make_units, so records of a changed setup are not reused.
+"""
+
+# Imports
+import concurrent.futures
+import os
+import zlib
+import joblib
+import numpy as np
+import executors
+import tf_cache
+
+
+def time_chunks(n_times, chunk_size):
+    """Consecutive (start, stop) chunks of n_times time points."""
+    return [
+        (start, min(start + chunk_size, n_times))
+        for start in range(0, n_times, chunk_size)
+    ]
+
+
+def make_units(subject, task_groups, n_times, chunk_size=16, setup=""):
+    """Units of a subject, one per task group and chunk of time points.
+
+    task_groups are as returned by task_specs.CompiledTasks.task_groups (or
+    compacted by decoding_dispatch.compact_task_group). setup is a hash of
+    everything else the results depend on (e.g. a tf_cache key combined with
+    the plan parameters), its first 12 characters are part of the keys. Units
+    are dicts with a "key" naming their record, the "subject", the
+    "task_group", and "start" and "stop" of the time chunk.
+    """
+    units = []
+    for task_group in task_groups:
+
+        # Identify group by its task labels
+        labels = ",".join(
+            decoding_task["label"] for decoding_task in task_group["tasks"]
+        )
+        group_key = f"{zlib.crc32(labels.encode()):08x}"
+
+        for start, stop in time_chunks(n_times, chunk_size):
+            units.append(
+                {
+                    "key": f"{subject}_{setup[:12]}_{group_key}_{start:04d}-{stop:04d}",
+                    "subject": subject,
+                    "task_group": task_group,
+                    "start": start,
+                    "stop": stop,
+                }
+            )
+
+    return units
+
+
+def record_file(path_jobs, unit):
+    """File name of the completion record of a unit."""
+    return os.path.join(path_jobs, f"{unit['key']}.joblib")
+
+
+def pending_units(units, path_jobs):
+    """Units without completion record."""
+    return [unit for unit in units if not os.path.isfile(record_file(path_jobs, unit))]
+
+
+def run_unit(function, unit, file_name, kwargs):
+    """Run a unit and record its result atomically."""
+    result = function(unit, **kwargs)
+    tf_cache.write_atomic(file_name, lambda tmp: joblib.dump(result, tmp))
+
+
+def run_units(function, units, path_jobs, n_concurrent=-2, executor=None, **kwargs):
+    """Run all units without completion record.
+
+    function is called as function(unit, **kwargs) in a worker and has to
+    return a dict mapping task labels to results over the time points of the
+    unit. Units are run by executor (see executors), by default locally with at
+    most n_concurrent units at once (joblib n_jobs semantics). Returns the
+    number of units that were run.
+    """
+
+    # Make sure jobs dir exists
+    os.makedirs(path_jobs, exist_ok=True)
+
+    # Resume: skip recorded units
+    units = pending_units(units, path_jobs)
+
+    # Run remaining units
+    if executor is None:
+        executor = executors.LocalExecutor(n_jobs=n_concurrent)
+    executor.map(
+        run_unit,
+        [(function, unit, record_file(path_jobs, unit), kwargs) for unit in units],
+    )
+
+    return len(units)
+
+
+def collect_units(units, path_jobs, n_times):
+    """Results of recorded units, as a dict mapping task labels to (n_times, ...)."""
+    results = {}
+    for unit in units:
+        for label, value in joblib.load(record_file(path_jobs, unit)).items():
+            value = np.asarray(value)
+            if label not in results:
+                results[label] = np.zeros((n_times,) + value.shape[1:], value.dtype)
+            results[label][unit["start"] : unit["stop"]] = value
+
+    return results
+
+
+def prefetch(items, prepare):
+    """Yield prepare(item) for all items, preparing the next item in a thread
+    while the current one is processed."""
+    items = list(items)
+    if not items:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(prepare, items[0])
+        for item in items[1:]:
+            prepared = future.result()
+            future = executor.submit(prepare, item)
+            yield prepared
+        yield future.result()
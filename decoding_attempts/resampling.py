@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Undersampling plans shared across time slices.
+
+The undersampling of a decoding task only depends on its labels, which are the
+same at all time points. A plan draws the balanced, shuffled trial orders of all
+iterations once per task. Every time slice applies the same plan by fancy
+indexing, so time courses are based on the same trials and the resampling is
+not repeated per time slice.
+"""
+
+# Imports
+import numpy as np
+import binning
+import rng_streams
+
+
+class ResamplingPlan:
+    """Balanced trial index sets of a decoding task for all iterations.
+
+    y are the labels of the trials selected by the task. idx holds indices into
+    these trials as (n_iterations, 2, n_per_class), class 0 first. Every
+    iteration is drawn from its own stream below seed (see rng_streams), so the
+    draw is reproducible and the first iterations do not change if
+    n_iterations is increased.
+    """
+
+    def __init__(self, y, n_iterations=50, seed=None):
+        self.n_iterations = n_iterations
+        self.seed = rng_streams.stream(seed)
+        self.idx = np.concatenate(
+            [
+                binning.balanced_permutations(y, 1, random_state=iteration_seed)
+                for iteration_seed in rng_streams.children(self.seed, n_iterations)
+            ]
+        ).astype(np.int32)
+
+    @property
+    def n_per_class(self):
+        return self.idx.shape[2]
+
+    def trials(self, iteration):
+        """Trial indices of one iteration as class blocks (class 0, then class 1)."""
+        return self.idx[iteration].ravel()
+
+    def bin(self, X, binsize=15):
+        """Bins of all iterations of the task trials X (n_trials, n_features).
+
+        Returns bins as (n_iterations, 2, n_bins, n_features).
+        """
+        return binning.bin_trials(X, self.idx, binsize)
+
+
+def make_plans(trialinfo, decoding_tasks, n_iterations=50, seed=None):
+    """Plans for a list of decoding tasks, as a dict keyed by task label.
+
+    Each task draws from the stream of its label below seed, e.g. the stream of
+    a subject. Plans therefore do not depend on the order of tasks.
+    """
+    return {
+        decoding_task["label"]: ResamplingPlan(
+            trialinfo[decoding_task["y_col"]][decoding_task["trial_idx"]],
+            n_iterations=n_iterations,
+            seed=rng_streams.stream(seed, decoding_task["label"]),
+        )
+        for decoding_task in decoding_tasks
+    }
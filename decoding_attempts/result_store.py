@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Store for decoding results of an analysis.
+
+A store is a directory with one .npy file per array:
+
+    acc.npy         accuracies as task x subject x time (x time for temporal
+                    generalization)
+    importance.npy  optional feature importances as
+                    task x subject x time x channel x band
+    importance_var.npy
+                    their variance across folds, same shape
+    done.npy        task x subject mask of written results
+    meta.joblib     labels, subjects, times, freqs, info object, ...
+
+Metadata is stored once. Arrays are written in place per task and subject and
+are opened memory-mapped, so loading an analysis is a single read.
+"""
+
+# Imports
+import os
+import joblib
+import numpy as np
+import tf_cache
+
+
+class ResultStore:
+    """Decoding results of an analysis, opened from path."""
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        self.meta = joblib.load(os.path.join(path, "meta.joblib"))
+        self.labels = list(self.meta["labels"])
+        self.subjects = list(self.meta["subjects"])
+        self.times = self.meta["times"]
+        self.acc = np.load(os.path.join(path, "acc.npy"), mmap_mode=mode)
+        self.done = np.load(os.path.join(path, "done.npy"), mmap_mode=mode)
+        self.importance = None
+        self.importance_var = None
+        for name in ("importance", "importance_var"):
+            file_name = os.path.join(path, f"{name}.npy")
+            if os.path.isfile(file_name):
+                setattr(self, name, np.load(file_name, mmap_mode=mode))
+
+    @property
+    def info_object(self):
+        return self.meta.get("info_object")
+
+    def index(self, label, subject):
+        """Task and subject index of a result."""
+        return self.labels.index(label), self.subjects.index(subject)
+
+    def is_done(self, label, subject):
+        return bool(self.done[self.index(label, subject)])
+
+    def write(self, label, subject, acc, importance=None, importance_var=None):
+        """Write the result of a task and subject and mark it done.
+
+        importance_var is ignored by stores created without it.
+        """
+        task_idx, subject_idx = self.index(label, subject)
+        self.acc[task_idx, subject_idx] = acc
+        if importance is not None:
+            self.importance[task_idx, subject_idx] = importance
+        if importance_var is not None and self.importance_var is not None:
+            self.importance_var[task_idx, subject_idx] = importance_var
+        self.acc.flush()
+        for array in (self.importance, self.importance_var):
+            if array is not None:
+                array.flush()
+
+        # Mark as done after the data is on disk
+        self.done[task_idx, subject_idx] = True
+        self.done.flush()
+
+    def select(self, label, complete=True):
+        """Accuracies of a task as subject x time (x time).
+
+        If complete, only subjects with results are returned.
+        """
+        task_idx = self.labels.index(label)
+        if complete:
+            return np.asarray(self.acc[task_idx][self.done[task_idx]])
+        return np.asarray(self.acc[task_idx])
+
+    def select_importance(self, label, complete=True, variance=False):
+        """Importances (or with variance, their variance across folds) of a task
+        as subject x time x channel x band."""
+        task_idx = self.labels.index(label)
+        importance = self.importance_var if variance else self.importance
+        if complete:
+            return np.asarray(importance[task_idx][self.done[task_idx]])
+        return np.asarray(importance[task_idx])
+
+
+def create(
+    path,
+    labels,
+    subjects,
+    times,
+    temporal_generalization=False,
+    importance_shape=None,
+    **meta,
+):
+    """Create a store, or open it for writing if it exists with the same layout.
+
+    importance_shape is (n_channels, n_bands) if importances and their
+    variances are stored. Further keyword arguments (e.g. freqs, info_object)
+    are stored as metadata. An existing store has to match labels, subjects,
+    times, temporal_generalization and importance_shape, else ValueError is
+    raised before anything is decoded into it.
+    """
+
+    # Layout of the arrays
+    n_times = len(times)
+    acc_shape = (len(labels), len(subjects), n_times)
+    if temporal_generalization:
+        acc_shape += (n_times,)
+    if importance_shape is not None:
+        importance_shape = tuple(importance_shape)
+
+    # Reuse an existing store with the same tasks, subjects, times, mode and arrays
+    meta_file = os.path.join(path, "meta.joblib")
+    if os.path.isfile(meta_file):
+        store = ResultStore(path, mode="r+")
+        stored_importance_shape = (
+            None if store.importance is None else store.importance.shape[3:]
+        )
+        if (
+            store.labels == list(labels)
+            and store.subjects == list(subjects)
+            and np.array_equal(store.times, times)
+            and store.meta.get("temporal_generalization") == temporal_generalization
+            and store.acc.shape == acc_shape
+            and stored_importance_shape == importance_shape
+        ):
+            return store
+        raise ValueError(
+            f"result store {path} exists with a different layout "
+            f"(acc {store.acc.shape}, importance {stored_importance_shape}; "
+            f"requested acc {acc_shape}, importance {importance_shape})"
+        )
+
+    # Make sure store dir exists
+    os.makedirs(path, exist_ok=True)
+
+    # Allocate arrays. Missing results are NaN
+    acc = np.lib.format.open_memmap(
+        os.path.join(path, "acc.npy"), mode="w+", dtype=np.float32, shape=acc_shape
+    )
+    acc[:] = np.nan
+    acc.flush()
+    done = np.lib.format.open_memmap(
+        os.path.join(path, "done.npy"),
+        mode="w+",
+        dtype=bool,
+        shape=(len(labels), len(subjects)),
+    )
+    done.flush()
+    if importance_shape is not None:
+        for name in ("importance", "importance_var"):
+            importance = np.lib.format.open_memmap(
+                os.path.join(path, f"{name}.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(len(labels), len(subjects), n_times) + importance_shape,
+            )
+            importance[:] = np.nan
+            importance.flush()
+            del importance
+    del acc, done
+
+    # Metadata is written last and marks a complete store
+    meta.update(
+        {
+            "labels": list(labels),
+            "subjects": list(subjects),
+            "times": np.asarray(times),
+            "temporal_generalization": temporal_generalization,
+        }
+    )
+    tf_cache.write_atomic(meta_file, lambda tmp: joblib.dump(meta, tmp))
+
+    return ResultStore(path, mode="r+")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Queries of group statistics on a result store.
+
+Data of a task is read from the store once, when it is first needed. Group
+means and SEMs are vectorized reductions over the subject axis. They are kept
+in memory per selection of tasks and smoothing for the lifetime of the query
+object (nothing is cached on disk), so plots of one script can be redone with
+other smoothing or selections without reading the store again. A selection of several task
+labels is averaged per subject (e.g. the color and tilt versions of a task).
+Selections can be made by factor levels of declared tasks, see task_specs.
+Smoothing is applied to the whole subject matrix of a selection, along all time
+axes (both for temporal generalization), and the times are smoothed with it.
+"""
+
+# Imports
+import collections.abc
+import numpy as np
+import result_store
+import smoothing
+import task_specs
+
+
+class ResultsQuery:
+    """Group means, SEMs and subject matrices of a result store."""
+
+    def __init__(self, path):
+        self.store = result_store.ResultStore(path)
+        self.info_object = self.store.info_object
+        self.labels = self.store.labels
+        self._data = {}
+        self._aggregates = {}
+
+    @property
+    def time_axes(self):
+        """Time axes of subject matrices."""
+        if self.store.meta.get("temporal_generalization", False):
+            return (-2, -1)
+        return (-1,)
+
+    def times(self, smoothing_length=1, mode="centred"):
+        """Times of data smoothed with smoothing_length and mode."""
+        return smoothing.window_times(self.store.times, smoothing_length, mode)
+
+    def select(self, target=None, **levels):
+        """Labels of tasks with target and factor levels, from the declared
+        tasks stored with the results (see task_specs.select)."""
+        return task_specs.select(self.store.meta["tasks"], target, **levels)
+
+    def task_data(self, label):
+        """Accuracies of a task as subject x time (x time), read once."""
+        if label not in self._data:
+            self._data[label] = np.array(self.store.acc[self.labels.index(label)])
+        return self._data[label]
+
+    def aggregate(self, labels, smoothing_length=1, mode="centred"):
+        """Subject matrix, mean and SEM of a selection of task labels.
+
+        Only subjects with results for all labels are used. Results are kept
+        in memory by this query object. Returns a dict with
+        "subjects" (subject ids), "data" (subject x time (x time)), "mean",
+        "sem" and the "times" of the smoothed data.
+        """
+
+        # Selection as tuple of labels
+        labels = (labels,) if isinstance(labels, str) else tuple(labels)
+        key = (labels, smoothing_length, mode)
+        if key in self._aggregates:
+            return self._aggregates[key]
+
+        # Subjects with all results
+        task_idx = [self.labels.index(label) for label in labels]
+        subject_idx = np.flatnonzero(np.asarray(self.store.done)[task_idx].all(axis=0))
+
+        # Subject matrix of the selection, smoothed in one pass
+        data = np.mean([self.task_data(label)[subject_idx] for label in labels], axis=0)
+        data, times = smoothing.smooth(
+            data, self.store.times, smoothing_length, mode, self.time_axes
+        )
+
+        # Group mean and standard error of the mean
+        n = data.shape[0]
+        mean = data.mean(axis=0)
+        if n > 1:
+            sem = data.std(axis=0, ddof=1) / np.sqrt(n)
+        else:
+            sem = np.zeros_like(mean)
+
+        self._aggregates[key] = {
+            "subjects": [self.store.subjects[idx] for idx in subject_idx],
+            "data": data,
+            "mean": mean,
+            "sem": sem,
+            "times": times,
+        }
+
+        return self._aggregates[key]
+
+    def subjects(self, labels, smoothing_length=1, mode="centred"):
+        """Per-subject data as subject x time (x time)."""
+        return self.aggregate(labels, smoothing_length, mode)["data"]
+
+    def mean(self, labels, smoothing_length=1, mode="centred"):
+        return self.aggregate(labels, smoothing_length, mode)["mean"]
+
+    def sem(self, labels, smoothing_length=1, mode="centred"):
+        return self.aggregate(labels, smoothing_length, mode)["sem"]
+
+    def aggregates(self, stat="mean", smoothing_length=1, mode="centred"):
+        """Lazy mapping of task labels to a statistic ("mean", "sem" or
+        "subjects"), computed on first access."""
+        return Aggregates(self, stat, smoothing_length, mode)
+
+
+class Aggregates(collections.abc.Mapping):
+    """Read-only mapping of task labels to a statistic of a ResultsQuery."""
+
+    def __init__(self, query, stat, smoothing_length, mode):
+        self.query = query
+        self.stat = stat
+        self.smoothing_length = smoothing_length
+        self.mode = mode
+
+    def __getitem__(self, label):
+        if label not in self.query.labels:
+            raise KeyError(label)
+        return getattr(self.query, self.stat)(label, self.smoothing_length, self.mode)
+
+    def __iter__(self):
+        return iter(self.query.labels)
+
+    def __len__(self):
+        return len(self.query.labels)
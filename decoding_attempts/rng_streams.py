@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reproducible random number streams for decoding.
+
+Every random draw is derived from a base seed and a key such as (subject, task,
+time slice, iteration). Keys are appended to the spawn key of a
+numpy.random.SeedSequence, so streams are statistically independent and do not
+depend on the order in which work is scheduled or on the number of workers.
+Task labels are turned into integers by their CRC32 checksum.
+"""
+
+# Imports
+import zlib
+import numpy as np
+
+
+def key_int(key):
+    """Integer key of an int or a string (CRC32 of the string)."""
+    if isinstance(key, str):
+        return zlib.crc32(key.encode())
+    return int(key)
+
+
+def stream(seed, *keys):
+    """SeedSequence of the stream identified by keys below seed.
+
+    seed is an int (or sequence of ints), None (fresh entropy) or a SeedSequence
+    returned by this function, in which case keys are appended to its key.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return np.random.SeedSequence(
+        seed.entropy, spawn_key=seed.spawn_key + tuple(key_int(x) for x in keys)
+    )
+
+
+def children(seed, n):
+    """Streams 0 ... n - 1 below seed, e.g. one per iteration."""
+    seed = stream(seed)
+    return [stream(seed, idx) for idx in range(n)]
+
+
+def generator(seed, *keys):
+    """numpy Generator of a stream."""
+    return np.random.default_rng(stream(seed, *keys))
+
+
+def random_state(seed, *keys):
+    """Integer seed of a stream, for sklearn random_state arguments."""
+    return int(stream(seed, *keys).generate_state(1)[0])
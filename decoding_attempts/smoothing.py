@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Moving-average smoothing of result matrices.
+
+Windows are averaged with one cumulative sum per time axis over the whole array,
+e.g. subject x time or subject x train time x test time. Only complete windows
+are kept. Times are smoothed along with the data: a window is labelled with its
+first time point ("start", as FeatureProvider labels smoothed features), its
+last time point ("causal") or the mean of its time points ("centred").
+"""
+
+# Imports
+import numpy as np
+
+
+def moving_average(data, smoothing_length, axis=-1):
+    """Means of complete windows of smoothing_length samples along axis."""
+
+    # Nothing to smooth
+    data = np.asarray(data)
+    if smoothing_length == 1:
+        return data
+
+    # Cumulative sum with a leading zero, in double precision
+    data = np.moveaxis(data, axis, -1)
+    csum = np.zeros(data.shape[:-1] + (data.shape[-1] + 1,))
+    np.cumsum(data, axis=-1, out=csum[..., 1:])
+
+    # Window means
+    smoothed = (csum[..., smoothing_length:] - csum[..., :-smoothing_length]) / (
+        smoothing_length
+    )
+
+    return np.moveaxis(smoothed, -1, axis)
+
+
+def window_times(times, smoothing_length, mode="centred"):
+    """Times of complete windows, at their start ("start"), end ("causal") or
+    centre ("centred")."""
+    times = np.asarray(times)
+    if mode == "start":
+        return times[: len(times) - smoothing_length + 1]
+    if mode == "causal":
+        return times[smoothing_length - 1 :]
+    if mode == "centred":
+        return moving_average(times, smoothing_length)
+    raise ValueError(f"unknown mode '{mode}'")
+
+
+def smooth(data, times, smoothing_length, mode="centred", time_axes=(-1,)):
+    """Smooth data along its time axes.
+
+    time_axes are all axes with time points, e.g. (-2, -1) for temporal
+    generalization matrices. Returns the smoothed data and their times.
+    """
+    for axis in time_axes:
+        data = moving_average(data, smoothing_length, axis=axis)
+    return data, window_times(times, smoothing_length, mode)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cached, parallel cluster permutation tests of contrasts.
+
+A contrast is a dict with a "label" and the data of its conditions as "data1"
+and "data2" (subject x time (x time)). Contrasts are tested with
+cluster_stats.permutation_cluster_test (F-test) or, with test="1samp", with
+cluster_stats.permutation_cluster_1samp_test on data1 - data2 (paired t-test).
+Contrasts with the same number of subjects share one set of permutations.
+Results are cached in a directory, keyed by a hash of the data and the test
+parameters, so rerunning a figure script only tests changed contrasts. Tests
+that are not cached run in parallel with an executor.
+"""
+
+# Imports
+import hashlib
+import os
+import joblib
+import numpy as np
+import cluster_stats
+import executors
+import tf_cache
+
+
+def data_hash(arrays):
+    """Hash of the shapes, types and values of arrays."""
+    sha1 = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        sha1.update(f"{array.shape}{array.dtype.str}".encode())
+        sha1.update(array.tobytes())
+    return sha1.hexdigest()
+
+
+def run_test(data1, data2, permutations, test, threshold, tail):
+    """Test one contrast with given permutations. Returns a result dict."""
+    if test == "1samp":
+        T_obs, clusters, cluster_p_values, H0 = (
+            cluster_stats.permutation_cluster_1samp_test(
+                np.asarray(data1) - np.asarray(data2),
+                threshold,
+                tail=tail,
+                signs=permutations,
+            )
+        )
+    else:
+        T_obs, clusters, cluster_p_values, H0 = cluster_stats.permutation_cluster_test(
+            [data1, data2], threshold, tail=tail, orders=permutations
+        )
+    return {
+        "T_obs": T_obs,
+        "clusters": clusters,
+        "cluster_p_values": cluster_p_values,
+        "H0": H0,
+    }
+
+
+def run_contrasts(
+    contrasts,
+    path_cache,
+    threshold=3.0,
+    n_permutations=5000,
+    tail=0,
+    test="anova",
+    seed=42,
+    executor=None,
+):
+    """Test contrasts, loading cached results where available.
+
+    test is "anova" (F-test of data1 vs data2 as independent groups) or "1samp"
+    (t-test of paired differences). Returns a list of result dicts (T_obs,
+    clusters, cluster_p_values, H0) in the order of contrasts.
+    """
+
+    # Make sure cache dir exists
+    os.makedirs(path_cache, exist_ok=True)
+
+    # Default executor runs tests on all cores but one
+    if executor is None:
+        executor = executors.LocalExecutor(n_jobs=-2)
+
+    # Cache files of contrasts
+    params = {
+        "threshold": threshold,
+        "n_permutations": n_permutations,
+        "tail": tail,
+        "test": test,
+        "seed": seed,
+    }
+    cache_files = [
+        os.path.join(
+            path_cache,
+            tf_cache.cache_key(
+                data_hash([contrast["data1"], contrast["data2"]]), params
+            )
+            + ".joblib",
+        )
+        for contrast in contrasts
+    ]
+
+    # Permutations of contrasts to test, shared by contrasts with the same number of subjects
+    permutations, arg_tuples, todo = {}, [], []
+    for contrast_idx, contrast in enumerate(contrasts):
+        if os.path.isfile(cache_files[contrast_idx]):
+            continue
+        n1, n2 = len(contrast["data1"]), len(contrast["data2"])
+        if (n1, n2) not in permutations:
+            if test == "1samp":
+                permutations[(n1, n2)] = cluster_stats.sign_flips(
+                    n1, n_permutations, seed
+                )
+            else:
+                permutations[(n1, n2)] = cluster_stats.label_permutations(
+                    n1 + n2, n_permutations, seed
+                )
+        arg_tuples.append(
+            (
+                contrast["data1"],
+                contrast["data2"],
+                permutations[(n1, n2)],
+                test,
+                threshold,
+                tail,
+            )
+        )
+        todo.append(contrast_idx)
+
+    # Test and cache
+    for contrast_idx, result in zip(todo, executor.map(run_test, arg_tuples)):
+        tf_cache.write_atomic(
+            cache_files[contrast_idx], lambda tmp: joblib.dump(result, tmp)
+        )
+
+    return [joblib.load(cache_file) for cache_file in cache_files]
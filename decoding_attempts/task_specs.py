@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Declarative decoding tasks.
+
+Tasks are declared as a decoding target crossed with factors of trial
+selection, e.g.
+
+    declare("cue", ["sequence", "reward", "task"])
+
+declares the 8 tasks "cue_in_repeat_in_standard_in_color", ...,
+"cue_in_switch_in_bonus_in_tilt". A declared task is a dict with its "label",
+"target", "y_col", factor "levels" and the trialinfo "conditions" (column,
+value) selecting its trials.
+
+compile_tasks turns declared tasks into the trial masks of a subject. Every
+condition mask and every combination of conditions is computed once, identical
+masks are stored once as a packed bitset, and tasks refer to them by index.
+The compiled tasks provide the decoding tasks and task groups of
+decoding_scheduler, and the declared tasks are stored with the results so that
+ResultsQuery can select labels by factor levels.
+"""
+
+# Imports
+import itertools
+import numpy as np
+
+# Decoding targets as trialinfo columns (see trialinfo_schema)
+TARGETS = {
+    "bonus_vs_standard": "bonustrial",
+    "task": "tilt_task",
+    "cue": "cue_ax",
+    "response": "response_side",
+    "target": "position_target",
+    "distractor": "position_distractor",
+}
+
+# Factors of trial selection as trialinfo column and values of levels
+FACTORS = {
+    "sequence": ("task_switch", {"repeat": 0, "switch": 1}),
+    "reward": ("bonustrial", {"standard": 0, "bonus": 1}),
+    "task": ("tilt_task", {"color": 0, "tilt": 1}),
+}
+
+
+def declare(target, factors=()):
+    """Tasks decoding target in all combinations of levels of factors.
+
+    Levels are combined in the order of factors, the last one changing
+    fastest. Labels are the target followed by "_in_<level>" per factor.
+    """
+    tasks = []
+    for levels in itertools.product(*[FACTORS[factor][1] for factor in factors]):
+        tasks.append(
+            {
+                "label": "_in_".join((target,) + levels),
+                "target": target,
+                "y_col": TARGETS[target],
+                "levels": dict(zip(factors, levels)),
+                "conditions": tuple(
+                    (FACTORS[factor][0], FACTORS[factor][1][level])
+                    for factor, level in zip(factors, levels)
+                ),
+            }
+        )
+    return tasks
+
+
+def select(tasks, target=None, **levels):
+    """Labels of declared tasks with target and factor levels.
+
+    Factors not given are not restricted, e.g. select(tasks, "cue",
+    sequence="repeat", reward="standard") returns the color and tilt version.
+    """
+    return tuple(
+        task["label"]
+        for task in tasks
+        if (target is None or task["target"] == target)
+        and all(task["levels"].get(factor) == level for factor, level in levels.items())
+    )
+
+
+class CompiledTasks:
+    """Trial masks of declared tasks for a structured trialinfo.
+
+    masks holds the distinct masks as packed bitsets (n_masks x n_bytes),
+    mask_idx the mask of each task.
+    """
+
+    def __init__(self, trialinfo, tasks):
+        self.tasks = list(tasks)
+        self.labels = [task["label"] for task in self.tasks]
+        self.n_trials = len(trialinfo)
+
+        # Masks of conditions and of combinations of conditions, computed once
+        condition_masks = {}
+        combination_masks = {(): np.ones(self.n_trials, dtype=bool)}
+        for task in self.tasks:
+            combination = ()
+            for condition in sorted(task["conditions"]):
+                if condition not in condition_masks:
+                    column, value = condition
+                    condition_masks[condition] = trialinfo[column] == value
+                if combination + (condition,) not in combination_masks:
+                    combination_masks[combination + (condition,)] = (
+                        combination_masks[combination] & condition_masks[condition]
+                    )
+                combination += (condition,)
+
+        # Distinct masks as bitsets, in order of first use
+        bitsets, mask_idx = {}, []
+        for task in self.tasks:
+            bitset = np.packbits(
+                combination_masks[tuple(sorted(task["conditions"]))]
+            ).tobytes()
+            mask_idx.append(bitsets.setdefault(bitset, len(bitsets)))
+        self.masks = np.frombuffer(b"".join(bitsets), dtype=np.uint8).reshape(
+            len(bitsets), -1
+        )
+        self.mask_idx = np.array(mask_idx)
+        self._trial_idx = [None] * len(bitsets)
+
+    def trial_idx(self, mask_nr):
+        """Boolean trial mask, unpacked once."""
+        if self._trial_idx[mask_nr] is None:
+            self._trial_idx[mask_nr] = np.unpackbits(
+                self.masks[mask_nr], count=self.n_trials
+            ).astype(bool)
+        return self._trial_idx[mask_nr]
+
+    def decoding_tasks(self):
+        """Decoding tasks as dicts with "label", "trial_idx" and "y_col".
+
+        Tasks with identical masks share the same trial_idx array.
+        """
+        return [
+            {
+                "label": task["label"],
+                "trial_idx": self.trial_idx(mask_nr),
+                "y_col": task["y_col"],
+            }
+            for task, mask_nr in zip(self.tasks, self.mask_idx)
+        ]
+
+    def task_groups(self, decoding_tasks=None):
+        """Tasks grouped by mask, as dicts with the shared "trial_idx" and the
+        list of "tasks", in order of first occurrence.
+
+        decoding_tasks (e.g. with plans attached) default to decoding_tasks().
+        """
+        if decoding_tasks is None:
+            decoding_tasks = self.decoding_tasks()
+        groups = {}
+        for decoding_task, mask_nr in zip(decoding_tasks, self.mask_idx):
+            if mask_nr not in groups:
+                groups[mask_nr] = {"trial_idx": self.trial_idx(mask_nr), "tasks": []}
+            groups[mask_nr]["tasks"].append(decoding_task)
+        return list(groups.values())
+
+
+def compile_tasks(trialinfo, tasks):
+    """Compile declared tasks for a trialinfo, see CompiledTasks."""
+    return CompiledTasks(trialinfo, tasks)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for band-power features.
+
+Entries are keyed by a hash of the dataset content and of the parameters of the
+time-frequency analysis (channel picks, frequencies, cycles, decimation, time
+window, bands). Data is stored as .npy and opened memory-mapped, times and info
+object are stored with joblib. Changing classifier settings or decoding tasks
+reuses the cached features. Streaming computations write their data directly
+into the cache file instead of returning it in memory.
+"""
+
+# Imports
+import hashlib
+import json
+import os
+import joblib
+import numpy as np
+
+
+def file_hash(file_name, chunk_size=2**24):
+    """SHA1 of file content."""
+    sha1 = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def dataset_hash(dataset, path_cache):
+    """Content hash of a .set file and its .fdt file, if present.
+
+    Hashes are remembered by file size and modification time, so unchanged files
+    are not read again.
+    """
+
+    # Files that make up the dataset
+    files = [dataset]
+    fdt_file = os.path.splitext(dataset)[0] + ".fdt"
+    if os.path.isfile(fdt_file):
+        files.append(fdt_file)
+
+    # Load remembered hashes
+    hash_file = os.path.join(path_cache, "dataset_hashes.json")
+    known = {}
+    if os.path.isfile(hash_file):
+        with open(hash_file) as f:
+            known = json.load(f)
+
+    # Hash files not seen in this version
+    sha1 = hashlib.sha1()
+    for file_name in files:
+        stat = os.stat(file_name)
+        stamp = f"{os.path.abspath(file_name)}:{stat.st_size}:{stat.st_mtime_ns}"
+        if stamp not in known:
+            known[stamp] = file_hash(file_name)
+        sha1.update(known[stamp].encode())
+
+    # Remember hashes
+    def write(tmp_file):
+        with open(tmp_file, "w") as f:
+            json.dump(known, f)
+
+    write_atomic(hash_file, write)
+
+    return sha1.hexdigest()
+
+
+def cache_key(data_hash, params):
+    """Key of a cache entry from dataset hash and analysis parameters."""
+    params = json.dumps(
+        params, sort_keys=True, default=lambda x: np.asarray(x).tolist()
+    )
+    return hashlib.sha1(f"{data_hash}:{params}".encode()).hexdigest()
+
+
+def entry_key(path_cache, dataset, params):
+    """Key of the cache entry of a dataset and analysis parameters."""
+    return cache_key(dataset_hash(dataset, path_cache), params)
+
+
+def save_npy(file_name, array):
+    """np.save to exactly this file name (np.save appends .npy to names)."""
+    with open(file_name, "wb") as f:
+        np.save(f, array)
+
+
+def write_atomic(file_name, write):
+    """Call write on a temporary file name, then move it into place."""
+    tmp_file = f"{file_name}.{os.getpid()}.tmp"
+    write(tmp_file)
+    os.replace(tmp_file, file_name)
+
+
+def load_or_compute(path_cache, dataset, params, compute, streaming=False):
+    """Load cached band-power features or compute and cache them.
+
+    compute is called as compute(dataset, **params) and has to return
+    (tf_data, tf_times, info_object). With streaming, it is called as
+    compute(dataset, out_file=file_name, **params) and has to write tf_data to
+    file_name as .npy (e.g. tf_features.streamed_band_power). Returns the
+    same, with tf_data memory-mapped read-only from the cache.
+    """
+
+    # Make sure cache dir exists
+    os.makedirs(path_cache, exist_ok=True)
+
+    # Cache files of this entry
+    key = entry_key(path_cache, dataset, params)
+    data_file = os.path.join(path_cache, f"{key}.npy")
+    meta_file = os.path.join(path_cache, f"{key}.joblib")
+
+    # Compute if not cached. Metadata is written last and marks complete entries
+    if not os.path.isfile(meta_file):
+        if streaming:
+            results = []
+            write_atomic(
+                data_file,
+                lambda tmp: results.extend(compute(dataset, out_file=tmp, **params)),
+            )
+            _, tf_times, info_object = results
+        else:
+            tf_data, tf_times, info_object = compute(dataset, **params)
+            write_atomic(data_file, lambda tmp: save_npy(tmp, tf_data))
+            del tf_data
+        write_atomic(
+            meta_file,
+            lambda tmp: joblib.dump(
+                {"times": tf_times, "info_object": info_object, "params": params}, tmp
+            ),
+        )
+
+    # Load entry
+    meta = joblib.load(meta_file)
+    tf_data = np.load(data_file, mmap_mode="r")
+
+    return tf_data, meta["times"], meta["info_object"]
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Band-power features for decoding.
+
+Single trial time-frequency power of the picked channels, averaged within
+frequency bands and cropped in time. The result is a trial x channel x band x
+time tensor.
+
+Band power is computed with frequency-domain kernels per band: all Morlet
+wavelets of the analysis frequencies within a band, averaged as mne's
+tfr_morlet band averages ("morlet"), fewer Morlet wavelets spread over each
+band ("wavelet", see wavelet_frequencies) or a band-pass analytic signal
+("hilbert"). All kernels are applied to one FFT of the data, and power is only
+computed at the kept (decimated, cropped) samples. With the number of wavelets
+derived from the bandwidth (the default), "wavelet" band power closely follows
+the Morlet band average with fewer wavelets. A fixed small number of wavelets
+per band does not cover wide bands (e.g. beta) and is no replacement for it.
+
+streamed_band_power reads chunks of trials from disk (see
+eeglab_io.trial_data) and writes their band power into a preallocated,
+optionally memory-mapped output. Once the data is on disk as .fdt or converted
+.npy, peak memory is set by the chunk size instead of the number of trials.
+"""
+
+# Imports
+import os
+import numpy as np
+import scipy.fft
+import mne
+import eeglab_io
+
+# Frequency bands as (label, lower edge, upper edge) in Hz
+bands = [
+    ("delta", 2, 3),
+    ("theta", 4, 7),
+    ("alpha", 8, 12),
+    ("beta", 13, 31),
+]
+
+
+def morlet_wavelet(sfreq, freq, n_cycles):
+    """Complex zero-mean Morlet wavelet, as in mne.time_frequency.morlet."""
+
+    # Gaussian width in time
+    sigma_t = n_cycles / (2.0 * np.pi * freq)
+
+    # Wavelet over +-5 standard deviations
+    t = np.arange(0.0, 5.0 * sigma_t, 1.0 / sfreq)
+    t = np.r_[-t[::-1], t[1:]]
+    oscillation = np.exp(2.0 * 1j * np.pi * freq * t)
+
+    # Remove the mean of the real part (zero_mean=True, the tfr_morlet default)
+    oscillation -= np.exp(-2 * (np.pi * freq * sigma_t) ** 2)
+
+    wavelet = oscillation * np.exp(-(t**2) / (2.0 * sigma_t**2))
+
+    # Normalize
+    wavelet /= np.sqrt(0.5) * np.linalg.norm(wavelet.ravel())
+
+    return wavelet
+
+
+def wavelet_frequencies(freqs, n_cycles, fmin, fmax, n_per_band=None):
+    """Centre frequencies of n_per_band wavelets standing in for the freqs of a band.
+
+    The freqs within [fmin, fmax] are split into n_per_band cells of equal
+    width, with a wavelet at the centre of each cell. With as many wavelets as
+    freqs these are the freqs themselves. With n_per_band None, the cells are
+    at most as wide as the spectral standard deviation (freq / n_cycles) of the
+    sharpest of these wavelets, so that together they cover the band like the
+    full set of freqs does. There are never more wavelets than freqs in the band.
+    """
+
+    # Wavelet frequencies and cycles within the band, or the band edges if there are none
+    in_band = (freqs >= fmin) & (freqs <= fmax)
+    if not np.any(in_band):
+        band_freqs, band_cycles = np.array([fmin, fmax]), np.interp(
+            [fmin, fmax], freqs, n_cycles
+        )
+    else:
+        band_freqs, band_cycles = freqs[in_band], n_cycles[in_band]
+
+    # Range covered by the freqs, including half a frequency step on both sides
+    step = 0.0
+    if band_freqs.size > 1:
+        step = (band_freqs[-1] - band_freqs[0]) / (band_freqs.size - 1)
+    low, width = band_freqs[0] - step / 2, band_freqs[-1] - band_freqs[0] + step
+
+    # Number of wavelets from bandwidth and spectral width
+    if n_per_band is None:
+        n_per_band = int(np.ceil(width / np.min(band_freqs / band_cycles)))
+    n_per_band = max(1, min(n_per_band, band_freqs.size))
+
+    return low + (np.arange(n_per_band) + 0.5) * width / n_per_band
+
+
+def band_kernels(sfreq, n_times, bands, method, freqs, n_cycles, n_per_band):
+    """Frequency-domain kernels per band.
+
+    Returns the FFT length and a list (one entry per band) of lists of
+    (kernel spectrum, sample offset) tuples. Power of a band is the mean power
+    of its kernels. n_per_band (wavelets per band for "wavelet") is None
+    (derived from the bandwidth), a number or one number per band.
+    """
+
+    # All wavelet frequencies within each band, as averaged from tfr_morlet power
+    if method == "morlet":
+        wavelets = [
+            [
+                morlet_wavelet(sfreq, freq, cycles)
+                for freq, cycles in zip(freqs, n_cycles)
+                if fmin <= freq <= fmax
+            ]
+            for _, fmin, fmax in bands
+        ]
+        n_fft = scipy.fft.next_fast_len(
+            n_times + max(w.size for band in wavelets for w in band) - 1
+        )
+        return n_fft, [
+            [(scipy.fft.fft(w, n_fft), (w.size - 1) // 2) for w in band]
+            for band in wavelets
+        ]
+
+    # Wavelets spread over the wavelet frequencies of each band, cycles interpolated
+    # from the Morlet setup
+    if method == "wavelet":
+        wavelets = [
+            [
+                morlet_wavelet(sfreq, freq, np.interp(freq, freqs, n_cycles))
+                for freq in wavelet_frequencies(freqs, n_cycles, fmin, fmax, n_band)
+            ]
+            for (_, fmin, fmax), n_band in zip(
+                bands, np.broadcast_to(np.array(n_per_band, dtype=object), len(bands))
+            )
+        ]
+        n_fft = scipy.fft.next_fast_len(
+            n_times + max(w.size for band in wavelets for w in band) - 1
+        )
+        return n_fft, [
+            [(scipy.fft.fft(w, n_fft), (w.size - 1) // 2) for w in band]
+            for band in wavelets
+        ]
+
+    # Band-pass analytic signal with 1 Hz cosine transitions
+    if method == "hilbert":
+        n_fft = scipy.fft.next_fast_len(n_times)
+        f = scipy.fft.fftfreq(n_fft, 1.0 / sfreq)
+        kernels = []
+        for _, fmin, fmax in bands:
+            gain = np.clip(np.minimum(f - fmin + 0.5, fmax + 0.5 - f), 0, 1)
+            gain = 0.5 - 0.5 * np.cos(np.pi * gain)
+            kernels.append([(2 * gain * (f > 0), 0)])
+        return n_fft, kernels
+
+    raise ValueError(f"unknown method '{method}'")
+
+
+def band_power_array(
+    data,
+    sfreq,
+    times,
+    decim,
+    crop,
+    bands=bands,
+    method="wavelet",
+    freqs=None,
+    n_cycles=None,
+    n_per_band=None,
+):
+    """Band power of a trial x channel x time array.
+
+    Power is only computed at the decimated samples within crop. Returns data
+    as trial x channel x band x time and the kept times. Computations are done
+    in the precision of data, i.e. single precision for float32 input.
+    """
+
+    # Get dims
+    n_trials, n_channels, n_times = data.shape
+
+    # Samples to keep
+    keep_idx = np.arange(0, n_times, decim)
+    keep_idx = keep_idx[(times[keep_idx] >= crop[0]) & (times[keep_idx] <= crop[1])]
+
+    # Kernels per band
+    n_fft, kernels = band_kernels(
+        sfreq, n_times, bands, method, freqs, n_cycles, n_per_band
+    )
+
+    # One FFT of all trials and channels
+    data_fft = scipy.fft.fft(data, n_fft, axis=-1)
+
+    # Band power at kept samples
+    tf_data = np.zeros(
+        (n_trials, n_channels, len(bands), len(keep_idx)), dtype=data.dtype
+    )
+    for band_idx, band_kernels_ in enumerate(kernels):
+        for kernel, offset in band_kernels_:
+            analytic = scipy.fft.ifft(
+                data_fft * kernel.astype(data_fft.dtype), axis=-1
+            )[..., keep_idx + offset]
+            tf_data[:, :, band_idx, :] += np.abs(analytic) ** 2 / len(band_kernels_)
+
+    return tf_data, times[keep_idx]
+
+
+def streamed_band_power(
+    dataset,
+    picks,
+    freqs,
+    n_cycles,
+    decim,
+    crop,
+    bands=bands,
+    method="morlet",
+    n_per_band=None,
+    dtype="float64",
+    out_file=None,
+    chunk_size=32,
+):
+    """Band power computed in chunks of chunk_size trials.
+
+    picks are channel labels, freqs and n_cycles the Morlet setup, decim the
+    decimation factor and crop the kept time window in s. method is "morlet"
+    (all wavelet frequencies of a band), "wavelet" or "hilbert", n_per_band the
+    number of wavelets per band for "wavelet" (see band_kernels). Chunks are
+    computed in double precision and stored in dtype. If out_file is given,
+    data is written to it as .npy and returned memory-mapped, and inline
+    dataset data is converted to .npy in the directory of out_file first (see
+    eeglab_io.trial_data) and removed again once done. Without out_file,
+    inline data is read into memory.
+    Returns data as trial x channel x band x time in dtype, the cropped times
+    and the info object of the picked channels.
+    """
+
+    # Open dataset and data readable in chunks of trials
+    eeg_dataset = eeglab_io.open_dataset(dataset)
+    eeg_data = eeglab_io.trial_data(
+        dataset, None if out_file is None else os.path.dirname(out_file)
+    )
+    times = eeg_dataset.epoch_times
+
+    # Get indices of channels to pick
+    to_pick_idx = [eeg_dataset.info.ch_names.index(x) for x in picks]
+
+    # Save info object for plotting topos
+    info_object = mne.pick_info(eeg_dataset.info, to_pick_idx)
+
+    # Band power chunk by chunk
+    n_trials = eeg_data.shape[0]
+    tf_data = None
+    for start in range(0, n_trials, chunk_size):
+        stop = min(start + chunk_size, n_trials)
+        tf_chunk, tf_times = band_power_array(
+            eeg_data[start:stop][:, to_pick_idx].astype(np.float64),
+            eeg_dataset.srate,
+            times,
+            decim,
+            crop,
+            bands=bands,
+            method=method,
+            freqs=np.asarray(freqs),
+            n_cycles=np.asarray(n_cycles),
+            n_per_band=n_per_band,
+        )
+
+        # Allocate output once the kept times are known
+        if tf_data is None:
+            shape = (n_trials,) + tf_chunk.shape[1:]
+            if out_file is None:
+                tf_data = np.empty(shape, dtype=dtype)
+            else:
+                tf_data = np.lib.format.open_memmap(
+                    out_file, mode="w+", dtype=dtype, shape=shape
+                )
+
+        tf_data[start:stop] = tf_chunk
+
+    # Write to disk and remove converted inline data
+    if out_file is not None:
+        tf_data.flush()
+        del eeg_data
+        eeglab_io.remove_trial_data(dataset, os.path.dirname(out_file))
+
+    return tf_data, tf_times, info_object
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Trial exclusion and recoding of trialinfo, cached per dataset.
+
+Trials of practice blocks, first trials of sequences and trials without a
+response are excluded. Positions of target and distractor, coded 1-8 starting
+at the top-right position and counting counter-clockwise, are recoded in
+position_bins bins: 2 bins are roughly left vs right, 4 bins follow
+https://www.nature.com/articles/s41598-019-45333-6.
+
+The result is the trialinfo of the kept trials and their trial numbers
+(trial_idx). It is cached next to the time-frequency cache, keyed like it by
+dataset hash and parameters. Feature tensors are not copied: trial_idx is
+applied where trials are read, e.g. by feature_provider.FeatureProvider.
+"""
+
+# Imports
+import os
+import numpy as np
+import tf_cache
+
+# Default filter parameters
+default_params = {
+    "min_block": 5,
+    "min_sequence_position": 2,
+    "response_sides": (0, 1),
+    "position_bins": 2,
+}
+
+
+def keep_mask(trialinfo, min_block=5, min_sequence_position=2, response_sides=(0, 1)):
+    """Trials to keep: not practice blocks, not first-of-sequence, with a response."""
+    return (
+        (trialinfo["block_nr"] >= min_block)
+        & (trialinfo["sequence_position"] >= min_sequence_position)
+        & np.isin(trialinfo["response_side"], response_sides)
+    )
+
+
+def recode_positions(trialinfo, position_bins=2):
+    """Copy of trialinfo with target and distractor positions in bins 0 to position_bins - 1."""
+    trialinfo = trialinfo.copy()
+    for column in ("position_target", "position_distractor"):
+        trialinfo[column] = (trialinfo[column] - 1) // (8 // position_bins)
+    return trialinfo
+
+
+def filter_trials(trialinfo, **params):
+    """Recoded trialinfo of kept trials and their trial numbers."""
+    params = {**default_params, **params}
+    trial_idx = np.flatnonzero(
+        keep_mask(
+            trialinfo,
+            params["min_block"],
+            params["min_sequence_position"],
+            params["response_sides"],
+        )
+    ).astype(np.int32)
+    return recode_positions(trialinfo[trial_idx], params["position_bins"]), trial_idx
+
+
+def load_or_compute(path_cache, dataset, load_trialinfo, **params):
+    """Filtered trialinfo and trial numbers of a dataset, from cache if possible.
+
+    load_trialinfo(dataset) has to return the structured trialinfo (see
+    trialinfo_schema.py). It is only called if the result is not cached. With
+    path_cache None, nothing is cached.
+    """
+
+    # No cache
+    if path_cache is None:
+        return filter_trials(load_trialinfo(dataset), **params)
+
+    # Cache files of this entry
+    os.makedirs(path_cache, exist_ok=True)
+    key = tf_cache.cache_key(
+        tf_cache.dataset_hash(dataset, path_cache),
+        {"trial_filter": {**default_params, **params}},
+    )
+    trialinfo_file = os.path.join(path_cache, f"{key}_trialinfo.npy")
+    trial_idx_file = os.path.join(path_cache, f"{key}_trial_idx.npy")
+
+    # Compute if not cached. Trial numbers are written last and mark complete entries
+    if not os.path.isfile(trial_idx_file):
+        trialinfo, trial_idx = filter_trials(load_trialinfo(dataset), **params)
+        tf_cache.write_atomic(
+            trialinfo_file, lambda tmp: tf_cache.save_npy(tmp, trialinfo)
+        )
+        tf_cache.write_atomic(
+            trial_idx_file, lambda tmp: tf_cache.save_npy(tmp, trial_idx)
+        )
+
+    return np.load(trialinfo_file), np.load(trial_idx_file)
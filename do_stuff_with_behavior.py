@@ -9,43 +9,18 @@ Created on Thu Mar  9 16:40:48 2023
 import numpy as np
 import os
 import pyddm as ddm
-import pandas as pd
+import trialinfo_schema
 
 # Paths
 path_in = "/home/plkn/bocotilt/behavior/"
 
-# Load data
-data = np.genfromtxt(os.path.join(path_in, "behavioral_data.csv"), delimiter=",")
-
-# Variable names
-varnames = [
-    "id",
-    "block_nr",
-    "trial_nr",
-    "bonustrial",
-    "tilt_task",
-    "cue_ax",
-    "target_red_left",
-    "distractor_red_left",
-    "response_interference",
-    "task_switch",
-    "prev_switch",
-    "prev_accuracy",
-    "correct_response",
-    "response_side",
-    "rt",
-    "rt_thresh_color",
-    "rt_thresh_tilt",
-    "accuracy",
-    "position_color",
-    "position_tilt",
-    "position_target",
-    "position_distractor",
-    "sequence_pos",
-]
+# Load data as structured array with named columns (see trialinfo_schema.py)
+trialinfo = trialinfo_schema.from_matrix(
+    np.genfromtxt(os.path.join(path_in, "behavioral_data.csv"), delimiter=",")
+)
 
 # Create data frame
-df = pd.DataFrame(data=data, columns=varnames)
+df = trialinfo_schema.to_frame(trialinfo)
 
 # Select subject
 df_id = df[df["id"] == 9]
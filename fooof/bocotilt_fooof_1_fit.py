@@ -5,7 +5,6 @@
 import glob
 import mne
 import numpy as np
-import pandas as pd
 import joblib
 import os
 import sys
@@ -22,6 +21,10 @@ sys.path.append(path_fooof)
 # Import fooof
 import fooof
 
+# Append repository root to sys path for the shared trialinfo schema
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import trialinfo_schema
+
 # Set sampling rate
 srate = 200
 
@@ -43,35 +46,8 @@ for counter_subject, dataset in enumerate(datasets):
     # Load times
     eeg_times = np.squeeze(scipy.io.loadmat(dataset)["times"])
 
-    # Load trialinfo
-    df_trialinfo = pd.DataFrame(scipy.io.loadmat(dataset)["trialinfo"])
-
-    # Set column labels
-    df_trialinfo.columns = [
-        "id",
-        "block",
-        "trial_nr",
-        "bonus",
-        "tilt_task",
-        "cue_ax",
-        "target_red_left",
-        "distractor_red_left",
-        "response_interference",
-        "task_switch",
-        "prev_switch",
-        "prev_accuracy",
-        "correct_response",
-        "response_side",
-        "rt",
-        "rt_thresh_color",
-        "rt_thresh_tilt",
-        "accuracy",
-        "position_color",
-        "position_tilt",
-        "position_target",
-        "position_distractor",
-        "sequence_position",
-    ]
+    # Load trialinfo as structured array with named columns (see trialinfo_schema.py)
+    trialinfo = trialinfo_schema.load_mat(dataset)
 
     # Get dims
     n_times, n_epochs = eeg_data.shape
@@ -88,7 +64,7 @@ for counter_subject, dataset in enumerate(datasets):
         "baseline": [],
         "ct_interval": [],
         "post_target": [],
-        "trialinfo": df_trialinfo,
+        "trialinfo": trialinfo,
     }
 
     # Loop timewins
@@ -3,6 +3,7 @@
 
 # Imports
 import glob
+import os
 import numpy as np
 import pandas as pd
 import joblib
@@ -20,6 +21,10 @@ sys.path.append(path_fooof)
 # Import fooof
 import fooof
 
+# Append repository root to sys path for the shared trialinfo schema
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import trialinfo_schema
+
 # List of datasets
 datasets = glob.glob(f"{path_in}/*.joblib")
 
@@ -64,13 +69,13 @@ for counter_subject, dataset in enumerate(datasets):
     fooof_data = joblib.load(dataset)
 
     # Get condition idx
-    tinf = fooof_data["trialinfo"]
+    tinf = trialinfo_schema.TrialIndex(fooof_data["trialinfo"])
 
     condition_idx = [
-        tinf.index[(tinf["bonus"] == 0) & (tinf["task_switch"] == 0)].tolist(),
-        tinf.index[(tinf["bonus"] == 0) & (tinf["task_switch"] == 1)].tolist(),
-        tinf.index[(tinf["bonus"] == 1) & (tinf["task_switch"] == 0)].tolist(),
-        tinf.index[(tinf["bonus"] == 1) & (tinf["task_switch"] == 1)].tolist(),
+        tinf.indices(bonustrial=0, task_switch=0),
+        tinf.indices(bonustrial=0, task_switch=1),
+        tinf.indices(bonustrial=1, task_switch=0),
+        tinf.indices(bonustrial=1, task_switch=1),
     ]
 
     # Condition labels
@@ -24,6 +24,10 @@ sys.path.append(path_fooof)
 # Import fooof
 import fooof
 
+# Append repository root to sys path for the shared trialinfo schema
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import trialinfo_schema
+
 # List of datasets
 datasets = glob.glob(f"{path_clean_data}/*_erp.set")
 
@@ -75,50 +79,15 @@ for counter_subject, dataset in enumerate(datasets):
     # Get FCz data (trials x times)
     fcz_data = eeg_data[126, :, :].T
     
-    # Create trialinfo as dataframe
-    df_trialinfo = pd.DataFrame(eeg["trialinfo"])
-
-    # Set trialinfo column labels
-    df_trialinfo.columns = [
-        "id",
-        "block",
-        "trial_nr",
-        "bonus",
-        "tilt_task",
-        "cue_ax",
-        "target_red_left",
-        "distractor_red_left",
-        "response_interference",
-        "task_switch",
-        "prev_switch",
-        "prev_accuracy",
-        "correct_response",
-        "response_side",
-        "rt",
-        "rt_thresh_color",
-        "rt_thresh_tilt",
-        "accuracy",
-        "position_color",
-        "position_tilt",
-        "position_target",
-        "position_distractor",
-        "sequence_position",
-    ]
+    # Trialinfo as structured array with named columns (see trialinfo_schema.py)
+    tinf = trialinfo_schema.TrialIndex(trialinfo_schema.from_matrix(eeg["trialinfo"]))
 
     # Get idx of conditions
     condition_idx = [
-        df_trialinfo.index[
-            (df_trialinfo["bonus"] == 0) & (df_trialinfo["task_switch"] == 0)
-        ].tolist(),
-        df_trialinfo.index[
-            (df_trialinfo["bonus"] == 0) & (df_trialinfo["task_switch"] == 1)
-        ].tolist(),
-        df_trialinfo.index[
-            (df_trialinfo["bonus"] == 1) & (df_trialinfo["task_switch"] == 0)
-        ].tolist(),
-        df_trialinfo.index[
-            (df_trialinfo["bonus"] == 1) & (df_trialinfo["task_switch"] == 1)
-        ].tolist(),
+        tinf.indices(bonustrial=0, task_switch=0),
+        tinf.indices(bonustrial=0, task_switch=1),
+        tinf.indices(bonustrial=1, task_switch=0),
+        tinf.indices(bonustrial=1, task_switch=1),
     ]
 
     # Condition labels
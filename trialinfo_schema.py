@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Schema of the trialinfo matrix of the bocotilt datasets.
+
+The preprocessing (bocotilt_preprocessing.m) writes one row per trial with the
+columns of COLUMNS. from_matrix turns such a matrix into a NumPy structured
+array with named columns in small types: codes as int8/int16, times as float32
+(they can be NaN). Columns are then addressed by name, e.g.
+trialinfo["task_switch"]. TrialIndex caches the boolean trial index of every
+column value it is asked for, so that repeated selections of conditions are
+lookups.
+
+Scripts outside this directory import it after adding the repository root to
+sys.path.
+"""
+
+# Imports
+import numpy as np
+import scipy.io
+
+# Columns of the trialinfo matrix and their types
+COLUMNS = [
+    ("id", "i2"),
+    ("block_nr", "i1"),
+    ("trial_nr", "i2"),
+    ("bonustrial", "i1"),
+    ("tilt_task", "i1"),
+    ("cue_ax", "i1"),
+    ("target_red_left", "i1"),
+    ("distractor_red_left", "i1"),
+    ("response_interference", "i1"),
+    ("task_switch", "i1"),
+    ("prev_switch", "i1"),
+    ("prev_accuracy", "i1"),
+    ("correct_response", "i1"),
+    ("response_side", "i1"),
+    ("rt", "f4"),
+    ("rt_thresh_color", "f4"),
+    ("rt_thresh_tilt", "f4"),
+    ("accuracy", "i1"),
+    ("position_color", "i1"),
+    ("position_tilt", "i1"),
+    ("position_target", "i1"),
+    ("position_distractor", "i1"),
+    ("sequence_position", "i2"),
+]
+names = [name for name, _ in COLUMNS]
+dtype = np.dtype(COLUMNS)
+
+
+def from_matrix(matrix):
+    """Structured trialinfo from a trials x columns matrix."""
+
+    # Check dims
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if matrix.ndim != 2 or matrix.shape[1] != len(COLUMNS):
+        raise ValueError(
+            f"trialinfo has to be trials x {len(COLUMNS)}, got {matrix.shape}"
+        )
+
+    # Fill columns. Integer columns have to hold integers in range of their type
+    trialinfo = np.empty(matrix.shape[0], dtype=dtype)
+    for column_idx, (name, column_type) in enumerate(COLUMNS):
+        values = matrix[:, column_idx]
+        if np.dtype(column_type).kind == "i":
+            info = np.iinfo(column_type)
+            if not (
+                np.all(values == np.round(values))
+                and np.all((values >= info.min) & (values <= info.max))
+            ):
+                raise ValueError(f"column {name} has values that are not {column_type}")
+        trialinfo[name] = values
+
+    return trialinfo
+
+
+def to_matrix(trialinfo):
+    """Trials x columns float matrix of a structured trialinfo."""
+    return np.column_stack([trialinfo[name].astype(np.float64) for name in names])
+
+
+def to_frame(trialinfo):
+    """Structured trialinfo as pandas.DataFrame with named columns."""
+
+    # Pandas is only needed for data frames
+    import pandas as pd
+
+    return pd.DataFrame(trialinfo)
+
+
+def load_mat(file_name, variable_name="trialinfo"):
+    """Structured trialinfo from a .mat (or .set) file."""
+    return from_matrix(
+        scipy.io.loadmat(file_name, variable_names=[variable_name])[variable_name]
+    )
+
+
+class TrialIndex:
+    """Boolean trial indexes of a structured trialinfo, computed once per column
+    and value."""
+
+    def __init__(self, trialinfo):
+        self.trialinfo = trialinfo
+        self._masks = {}
+
+    def mask(self, column, value):
+        """Trials with value in column."""
+        key = (column, value)
+        if key not in self._masks:
+            self._masks[key] = self.trialinfo[column] == value
+        return self._masks[key]
+
+    def select(self, **levels):
+        """Trials with all given column values, e.g. select(bonustrial=1, task_switch=0)."""
+        selection = np.ones(len(self.trialinfo), dtype=bool)
+        for column, value in levels.items():
+            selection &= self.mask(column, value)
+        return selection
+
+    def indices(self, **levels):
+        """Trial numbers of select(**levels)."""
+        return np.flatnonzero(self.select(**levels))